@@ -0,0 +1,78 @@
+import json
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.utils import timezone
+from . import changes, counters, search, tasks
+from .content import summaries
+
+# Request parsing and ownership checks shared by the write views. The body
+# is decoded once, and ownership is settled by the write itself or by one
+# query that reads author_id without loading the author.
+
+class VersionConflict(Exception):
+    """The row exists and is the user's, but not at a version If-Match allows."""
+
+def parse_body(request, *keys):
+    """
+    Returns the values of keys from the JSON body, in order. Raises
+    ValueError if the body is not a JSON object holding every key.
+    """
+    try:
+        data = json.loads(request.body.decode())
+        return [data[key] for key in keys]
+    except (KeyError, TypeError):
+        raise ValueError('missing field')
+
+def check_exists(model, pk):
+    if not model.objects.filter(pk=pk).exists():
+        raise Http404
+
+def check_owner(model, pk, user, *fields):
+    """
+    Returns the values of fields for the row if user is its author.
+    Raises Http404 or PermissionDenied otherwise.
+    """
+    row = model.objects.filter(pk=pk).values_list('author_id', *fields).first()
+    if row is None:
+        raise Http404
+    if row[0] != user.pk:
+        raise PermissionDenied
+    return row[1:]
+
+def update_owned(model, object_cache, pk, user, versions=None, parent=None, **values):
+    """
+    Applies values with one conditional UPDATE, or raises like check_owner.
+    With versions, only a row at one of them is updated, and VersionConflict
+    is raised otherwise. parent is the article of a comment, for the change
+    feed. Returns the new version when it is known.
+    """
+    queryset = model.objects.filter(pk=pk, author=user)
+    if versions is not None:
+        queryset = queryset.filter(version__in=versions)
+    values.update(summaries(model, values))
+    with transaction.atomic():
+        updated = queryset.update(updated_at=timezone.now(), version=F('version') + 1, **values)
+        if updated:
+            search.index(model, [model(pk=pk, **values)])
+            changes.record(model, 'update', [(pk, parent)])
+    if not updated:
+        check_owner(model, pk, user)
+        if versions is not None:
+            raise VersionConflict
+        raise Http404
+    # update() sends no post_save, so the detail cache is told directly.
+    object_cache.invalidate(pk)
+    return versions[0] + 1 if versions is not None and len(versions) == 1 else None
+
+def delete_owned(model, pk, user):
+    """Soft-deletes the row, leaving the purge to a worker, or raises like check_owner."""
+    queryset = model.objects.filter(pk=pk, author=user)
+    with transaction.atomic():
+        counters.deleting(queryset)
+        changes.deleting(queryset)
+        deleted = tasks.delete_later(queryset)
+    if not deleted:
+        check_owner(model, pk, user)
+        raise Http404
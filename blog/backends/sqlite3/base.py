@@ -0,0 +1,11 @@
+from django.db.backends.sqlite3 import base
+
+# SQLite with write transactions that wait for the lock. A deferred BEGIN
+# takes the write lock only at its first write, and if another connection
+# has committed since the transaction's first read SQLite fails it at once
+# with "database is locked" rather than honouring busy_timeout. BEGIN
+# IMMEDIATE takes the lock up front, where busy_timeout applies.
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
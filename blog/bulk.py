@@ -0,0 +1,136 @@
+import json
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import changes, counters, search, tasks
+from .content import summaries
+from .pagination import bounded
+
+# Batch writes. Each batch runs in one transaction with one bulk statement
+# per operation, and ownership of every referenced row is checked with a
+# single query. Results are reported per item, in request order.
+
+class ItemError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+def parse_items(body):
+    """Returns the JSON array in body. Raises ValueError if it is not one or is too long."""
+    items = json.loads(body)
+    if not isinstance(items, list) or len(items) > getattr(settings, 'BLOG_BULK_MAX_ITEMS', 1000):
+        raise ValueError('expected an array of at most BLOG_BULK_MAX_ITEMS items')
+    return items
+
+def _item_id(item):
+    try:
+        pk = item['id'] if isinstance(item, dict) else item
+    except KeyError:
+        raise ItemError(400)
+    if not isinstance(pk, int) or isinstance(pk, bool):
+        raise ItemError(400)
+    try:
+        return bounded(pk)
+    except ValueError:
+        raise ItemError(400)
+
+def _assign_created_ids(model, objs, author):
+    if all(obj.pk is not None for obj in objs):
+        return
+    # SQLite cannot return ids from a bulk insert. The transaction still
+    # holds its write lock, so the author's newest rows are the ones just
+    # inserted, in order.
+    pks = model.objects.filter(author=author).order_by('-pk').values_list('pk', flat=True)[:len(objs)]
+    for obj, pk in zip(objs, reversed(list(pks))):
+        obj.pk = pk
+
+def bulk_create(model, serializer, user, items, build):
+    """
+    Inserts build(item) for every item. build returns an unsaved instance
+    or raises ItemError, KeyError or TypeError to reject the item.
+    """
+    results = [None] * len(items)
+    objs, positions = [], []
+    for index, item in enumerate(items):
+        try:
+            objs.append(build(item))
+            positions.append(index)
+        except ItemError as e:
+            results[index] = {'status': e.status}
+        except (KeyError, TypeError):
+            results[index] = {'status': 400}
+    with transaction.atomic():
+        model.objects.bulk_create(objs)
+        _assign_created_ids(model, objs, user)
+        search.index(model, objs)
+        counters.created(model, objs)
+        changes.record(model, 'create', [(obj.pk, getattr(obj, 'article_id', None)) for obj in objs])
+    for index, obj in zip(positions, objs):
+        results[index] = {'status': 201, 'data': serializer.instance(obj)}
+    return results
+
+def _owned(serializer, user, items, results):
+    """
+    Returns {index: (pk, current data)} for the items the user may write,
+    filling results with 400/403/404 for the rest.
+    """
+    pks = {}
+    for index, item in enumerate(items):
+        try:
+            pks[index] = _item_id(item)
+        except ItemError as e:
+            results[index] = {'id': None, 'status': e.status}
+    fields = serializer.all_fields
+    rows = serializer.project(serializer.model.objects.filter(pk__in=set(pks.values())), fields)
+    current = {row[0]: serializer.row(fields)(row) for row in rows}
+    owned = {}
+    for index, pk in pks.items():
+        if pk not in current:
+            results[index] = {'id': pk, 'status': 404}
+        elif current[pk]['author'] != user.pk:
+            results[index] = {'id': pk, 'status': 403}
+        else:
+            owned[index] = (pk, current[pk])
+    return owned
+
+def bulk_update(serializer, object_cache, user, items, fields):
+    """Sets fields from each {'id': ..., field: ...} item the user owns."""
+    model = serializer.model
+    meta = model._meta
+    results = [None] * len(items)
+    now = timezone.now()
+    objs = []
+    with transaction.atomic():
+        for index, (pk, data) in _owned(serializer, user, items, results).items():
+            try:
+                data = dict(data, **{name: items[index][name] for name in fields})
+            except (KeyError, TypeError):
+                results[index] = {'id': pk, 'status': 400}
+                continue
+            objs.append(model(updated_at=now, version=F('version') + 1, **summaries(model, data),
+                              **{meta.get_field(name).attname: data[name] for name in data}))
+            results[index] = {'id': pk, 'status': 200, 'data': data}
+        # bulk_update skips save() and its signals, so timestamps, row
+        # versions, summaries, the search index and cache versions are
+        # maintained here.
+        derived = list(summaries(model, dict.fromkeys(fields, '')))
+        model.objects.bulk_update(objs, list(fields) + derived + ['updated_at', 'version'])
+        search.index(model, objs)
+        changes.record(model, 'update', [(obj.pk, getattr(obj, 'article_id', None)) for obj in objs])
+        for obj in objs:
+            object_cache.invalidate(obj.pk)
+    return results
+
+def bulk_delete(serializer, user, items):
+    """Deletes every item (an id or {'id': ...}) the user owns."""
+    results = [None] * len(items)
+    with transaction.atomic():
+        owned = _owned(serializer, user, items, results)
+        queryset = serializer.model.objects.filter(pk__in=[pk for pk, data in owned.values()], author=user)
+        counters.deleting(queryset)
+        changes.deleting(queryset)
+        tasks.delete_later(queryset)
+    for index, (pk, data) in owned.items():
+        results[index] = {'id': pk, 'status': 200}
+    return results
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router, transaction
+from django.shortcuts import get_object_or_404
+from .serializers import article_serializer, comment_serializer
+
+# Read-through cache for detail reads. Each object has a version number in
+# the shared backend; entries are stored under (id, version), so bumping the
+# version on write makes every older entry unreachable in every process.
+# A bounded in-process LRU sits in front and is checked against that version.
+
+class ObjectCache:
+    def __init__(self, serializer, prefix):
+        self.serializer = serializer
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.local = OrderedDict()
+        self.reset()
+
+    @property
+    def backend(self):
+        return caches[getattr(settings, 'BLOG_CACHE_ALIAS', 'default')]
+
+    def version_key(self, pk):
+        return 'blog:%s:%s:version' % (self.prefix, pk)
+
+    def data_key(self, pk, version):
+        return 'blog:%s:%s:%s' % (self.prefix, pk, version)
+
+    def version(self, pk):
+        version = self.backend.get(self.version_key(pk))
+        if version is None:
+            # A fresh clock-based version can never match an entry written
+            # before the version key was lost.
+            self.backend.add(self.version_key(pk), time.time_ns(), timeout=None)
+            version = self.backend.get(self.version_key(pk))
+        return version
+
+    def get(self, pk):
+        """
+        Returns (data, updated_at, row version) where data is the serialized
+        object with every field. Raises Http404 if the object does not exist.
+        """
+        version = self.version(pk)
+        with self.lock:
+            entry = self.local.get(pk)
+            if entry is not None and entry[0] == version:
+                self.local.move_to_end(pk)
+                self.stats['hits'] += 1
+                self.stats['local_hits'] += 1
+                return entry[1]
+
+        value = self.backend.get(self.data_key(pk, version))
+        if value is None:
+            self.stats['misses'] += 1
+            fields = self.serializer.all_fields
+            # Fill from the primary: a lagging replica would store the old
+            # row under the version a write has just bumped.
+            queryset = self.serializer.model.objects.using(router.db_for_write(self.serializer.model))
+            queryset = queryset.values_list(*fields, 'updated_at', 'version')
+            row = get_object_or_404(queryset, pk=pk)
+            value = (self.serializer.row(fields)(row[:-2]),) + row[-2:]
+            self.backend.set(self.data_key(pk, version), value, getattr(settings, 'BLOG_CACHE_TIMEOUT', 300))
+        else:
+            self.stats['hits'] += 1
+        self._store_local(pk, version, value)
+        return value
+
+    def _store_local(self, pk, version, value):
+        with self.lock:
+            self.local[pk] = (version, value)
+            self.local.move_to_end(pk)
+            while len(self.local) > getattr(settings, 'BLOG_CACHE_LOCAL_SIZE', 1024):
+                self.local.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, pk):
+        self._bump(pk)
+        # A reader may refill the cache from the old row before the write
+        # commits, so invalidate again once it has.
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._bump(pk))
+
+    def invalidate_many(self, pks):
+        """Like invalidate(), for many objects with one cache write each time."""
+        pks = list(pks)
+        if not pks:
+            return
+        self._bump_many(pks)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._bump_many(pks))
+
+    def _bump_many(self, pks):
+        with self.lock:
+            for pk in pks:
+                self.local.pop(pk, None)
+        # A fresh clock-based version, as for a lost version key.
+        version = time.time_ns()
+        self.backend.set_many({self.version_key(pk): version for pk in pks}, timeout=None)
+
+    def _bump(self, pk):
+        with self.lock:
+            self.local.pop(pk, None)
+        try:
+            self.backend.incr(self.version_key(pk))
+        except ValueError:
+            self.backend.add(self.version_key(pk), time.time_ns(), timeout=None)
+
+    def reset(self):
+        """Empties the in-process tier and zeroes the counters."""
+        with self.lock:
+            self.local.clear()
+            self.stats = {'hits': 0, 'local_hits': 0, 'misses': 0, 'evictions': 0}
+
+article_cache = ObjectCache(article_serializer, 'article')
+comment_cache = ObjectCache(comment_serializer, 'comment')
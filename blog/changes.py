@@ -0,0 +1,172 @@
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from . import events
+from .models import Article, Change, Comment
+from .pagination import bounded
+from .routers import primary
+from .serializers import article_serializer, comment_serializer
+
+# Append-only change feed for incremental sync. Every API path that
+# creates, updates or deletes articles or comments records one Change per
+# row in the transaction making the change; deletes leave tombstones, and
+# deleting an article leaves one for each of its comments as they are
+# purged. A page is one primary key range scan of the log from ?since=,
+# plus one query per kind for the rows' current data.
+
+SERIALIZERS = {'article': article_serializer, 'comment': comment_serializer}
+
+_condition = threading.Condition()
+_waiters = 0
+
+def _kind(model):
+    return 'article' if model is Article else 'comment'
+
+def record(model, action, rows):
+    """Records action for rows, (pk, article id of a comment or None) pairs."""
+    rows = list(rows)
+    if not rows:
+        return
+    Change.objects.bulk_create([Change(kind=_kind(model), object_id=pk, parent_id=parent, action=action)
+                                for pk, parent in rows])
+    transaction.on_commit(_notify)
+    if model is Comment:
+        parents = {parent for pk, parent in rows}
+        transaction.on_commit(lambda: comment_hub.publish(parents))
+
+def deleting(queryset):
+    """
+    Records tombstones for the rows of queryset; call before deleting them.
+    The comments of deleted articles get theirs as blog.tasks purges them.
+    """
+    if queryset.model is Article:
+        record(Article, 'delete', ((pk, None) for pk in queryset.values_list('pk', flat=True)))
+    else:
+        record(Comment, 'delete', queryset.values_list('pk', 'article_id'))
+
+def _notify():
+    with _condition:
+        _condition.notify_all()
+
+def _settled(rows, since):
+    """
+    Cuts rows at the first sequence gap younger than BLOG_CHANGES_SETTLE.
+    A gap is a transaction that drew its seq but has not committed yet (or
+    rolled back); serving past it would skip the change for good.
+    """
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'BLOG_CHANGES_SETTLE', 5))
+    expected = since + 1
+    for index, row in enumerate(rows):
+        if row.seq != expected and row.created_at > cutoff:
+            return rows[:index]
+        expected = row.seq + 1
+    return rows
+
+def _read(since, limit):
+    return _settled(list(Change.objects.filter(seq__gt=since).order_by('seq')[:limit]), since)
+
+def _wait(since, limit, timeout):
+    """Blocks until changes after since exist or timeout passes; returns them."""
+    global _waiters
+    with _condition:
+        # Each waiter holds a worker thread; past the cap, answer at once
+        # and leave the rest of the pool to other requests.
+        if _waiters >= getattr(settings, 'BLOG_CHANGES_MAX_WAITERS', 8):
+            return []
+        _waiters += 1
+    try:
+        deadline = time.monotonic() + timeout
+        poll = getattr(settings, 'BLOG_CHANGES_POLL_INTERVAL', 1)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            # Commits in this process wake the waiters; other processes'
+            # commits are found by polling.
+            with _condition:
+                _condition.wait(min(poll, remaining))
+            rows = _read(since, limit)
+            if rows:
+                return rows
+    finally:
+        with _condition:
+            _waiters -= 1
+
+def get_page(since, limit, wait=0):
+    """
+    Returns {'changes': [...], 'last_seq': ..., 'more': ...} for up to
+    limit changes after since, holding the request up to wait seconds
+    while there are none.
+    """
+    rows = _read(since, limit + 1)
+    if not rows and wait:
+        rows = _wait(since, limit + 1, wait)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {'changes': _entries(rows), 'last_seq': rows[-1].seq if rows else since, 'more': more}
+
+def _entries(rows):
+    """The feed entries for rows, with each row's current data from one query per kind."""
+    current = {}
+    for kind, serializer in SERIALIZERS.items():
+        pks = {row.object_id for row in rows if row.kind == kind}
+        if pks:
+            fields = serializer.all_fields
+            to_dict = serializer.row(fields)
+            current[kind] = {row[0]: to_dict(row) for row in serializer.project(
+                serializer.model.objects.filter(pk__in=pks), fields)}
+    return [{'seq': row.seq, 'type': row.kind, 'id': row.object_id, 'action': row.action,
+             # The row as it is now; None once deleted, by this change or a later one.
+             'data': current.get(row.kind, {}).get(row.object_id)} for row in rows]
+
+def comment_events(article_id, since):
+    """The article's comment changes after since, read from one index range in pages."""
+    limit = getattr(settings, 'BLOG_EVENTS_PAGE_SIZE', 500)
+    entries = []
+    # A lagging replica would hold back what the notification announced.
+    with primary():
+        while True:
+            queryset = Change.objects.filter(parent_id=article_id, kind='comment', seq__gt=since).order_by('seq')
+            rows = list(queryset[:limit])
+            entries.extend(_entries(rows))
+            if len(rows) < limit:
+                return entries
+            since = rows[-1].seq
+
+comment_hub = events.Hub('comments', comment_events)
+
+def subscribe_comments(request, article_id):
+    """
+    Subscribes to the article's comment changes after the Last-Event-ID
+    header (or ?last_event_id=), or after its latest one when neither is
+    given, and queues those already made. Raises ValueError on bad ids and
+    events.HubFull past the subscriber cap.
+    """
+    last_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('last_event_id'))
+    if last_id is None:
+        cursor = Change.objects.filter(parent_id=article_id).aggregate(seq=Max('seq'))['seq'] or 0
+    else:
+        cursor = bounded(int(last_id))
+        if cursor < 0:
+            raise ValueError('last event id must not be negative')
+    # Subscribing before reading the backlog means a change committed in
+    # between is delivered by one or the other; the cursor drops repeats.
+    subscription = comment_hub.subscribe(article_id, cursor, threaded=not events.streams_on_event_loop(request))
+    try:
+        subscription.deliver(comment_events(article_id, cursor))
+    except Exception:
+        subscription.close()
+        raise
+    return subscription
+
+def parse_since(request):
+    """Returns (since, wait) from ?since= and ?wait=. Raises ValueError on bad values."""
+    since = bounded(int(request.GET.get('since', 0)))
+    wait = float(request.GET.get('wait', 0))
+    if since < 0 or not 0 <= wait:
+        raise ValueError('since and wait must not be negative')
+    return since, min(wait, getattr(settings, 'BLOG_CHANGES_MAX_WAIT', 30))
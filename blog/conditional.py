@@ -0,0 +1,60 @@
+import hashlib
+import re
+from calendar import timegm
+from django.db.models import Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+from .models import Change
+from .streaming import wants_ndjson
+
+# Conditional requests. Validators are computed from updated_at and the row
+# version alone (two index seeks for collections, the cached row for
+# details), so a matching If-None-Match or If-Modified-Since is answered
+# before any row is loaded. Collections get an ETag only: their
+# MAX(updated_at) does not move when a row other than the newest is
+# deleted, so Last-Modified would answer 304 for a stale page. The ETag
+# also carries the latest change feed entry, which every API write,
+# delete included, moves; writes made around the API are seen only
+# through updated_at. Detail ETags start with the row version, which is
+# what an If-Match on a PUT is checked against.
+
+def collection_validators(model):
+    return (Change.objects.aggregate(seq=Max('seq'))['seq'],
+            last_modified(model))
+
+def last_modified(model):
+    # Live rows only, which the model's partial updated_at index holds.
+    return model.objects.aggregate(last_modified=Max('updated_at'))['last_modified']
+
+def make_etag(request, *state):
+    # Query parameters and the NDJSON flag change the body, so they are
+    # part of the tag.
+    key = '%s|%s|%s' % (request.get_full_path(), wants_ndjson(request), '|'.join(map(str, state)))
+    return '"%s"' % hashlib.md5(key.encode()).hexdigest()
+
+def detail_etag(request, pk, version):
+    return '"%d-%s"' % (version, make_etag(request, pk).strip('"'))
+
+def if_match_versions(request):
+    """
+    Returns the versions named by the If-Match detail ETags, or None when
+    the request may replace any version. Weak and foreign tags name none.
+    """
+    header = request.META.get('HTTP_IF_MATCH')
+    if header is None:
+        return None
+    etags = parse_etags(header)
+    if etags == ['*']:
+        return None
+    return [int(match.group(1)) for match in map(re.compile(r'"(\d+)-').match, etags) if match]
+
+def not_modified(request, etag, last_modified):
+    """Returns a 304 response when the request's validators match, else None."""
+    timestamp = timegm(last_modified.utctimetuple()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+    return response
@@ -0,0 +1,122 @@
+import re
+import zlib
+from base64 import b85decode, b85encode
+from django.conf import settings
+from django.db import models
+
+# Article and comment bodies. Bodies of BLOG_COMPRESS_CONTENT_OVER
+# characters or more are stored zlib-compressed: as a BLOB on SQLite, and
+# elsewhere as MARKER plus base85 text. CompressedTextField packs on every
+# save and unpacks on every ORM read, so views see plain text; raw SQL
+# reads go through unpack(). Written rows go to blog.search.index(), which
+# indexes the compressed bodies; save() does so through a signal.
+# Summaries are excerpts of the body stored beside it at write time, so
+# ?summary=1 list pages read neither the body nor the compressed bytes.
+
+MARKER = '\x1bz'
+
+LEVEL = 6
+
+def compressible(text):
+    """Whether pack() may store text compressed; it still keeps text that does not shrink."""
+    threshold = getattr(settings, 'BLOG_COMPRESS_CONTENT_OVER', None)
+    # Text that looks packed is always packed, so unpack() is never fooled.
+    return text.startswith(MARKER) or (threshold is not None and len(text) >= threshold)
+
+def pack(text, vendor):
+    """Returns the stored form of text for a database of vendor."""
+    if not compressible(text):
+        return text
+    forced = text.startswith(MARKER)
+    encoded = text.encode()
+    data = zlib.compress(encoded, LEVEL)
+    if vendor == 'sqlite':
+        return data if forced or len(data) < len(encoded) else text
+    packed = MARKER + b85encode(data).decode()
+    return packed if forced or len(packed) < len(encoded) else text
+
+def unpack(value):
+    if isinstance(value, (bytes, memoryview)):
+        return zlib.decompress(value).decode()
+    if isinstance(value, str) and value.startswith(MARKER):
+        return zlib.decompress(b85decode(value[len(MARKER):])).decode()
+    return value
+
+class CompressedTextField(models.TextField):
+    def from_db_value(self, value, expression, connection):
+        return unpack(value)
+
+    def get_db_prep_save(self, value, connection):
+        value = self.get_prep_value(value)
+        return value if value is None else pack(value, connection.vendor)
+
+def summarize(text):
+    """The first BLOG_SUMMARY_LENGTH characters of text, cut at a word, whitespace collapsed."""
+    if text is None:
+        return None
+    length = getattr(settings, 'BLOG_SUMMARY_LENGTH', 200)
+    text = ' '.join(str(text).split())
+    if len(text) <= length:
+        return text
+    cut = text[:length + 1]
+    match = re.match(r'(.*\S)\s', cut, re.S)
+    return (match.group(1) if match else text[:length]) + '...'
+
+class SummaryField(models.TextField):
+    """Holds summarize() of the source field, set on save() and bulk_create()."""
+
+    def __init__(self, *args, source='content', **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = summarize(getattr(model_instance, self.source))
+        setattr(model_instance, self.attname, value)
+        return value
+
+def summaries(model, values):
+    """
+    Returns {summary field name: value} for the summaries of model that
+    derive from values, for writes that skip pre_save (update(), bulk_update()).
+    """
+    return {field.name: summarize(values[field.source]) for field in model._meta.concrete_fields
+            if isinstance(field, SummaryField) and field.source in values}
+
+def repack(connection, table, inflate=False, chunk_size=500):
+    """
+    Rewrites the bodies in table packed for the current
+    BLOG_COMPRESS_CONTENT_OVER, compressing the long ones and inflating the
+    ones it no longer covers (with inflate, every one), and fills in their
+    summaries. Returns the stored bytes before and after.
+    """
+    qn = connection.ops.quote_name
+    select = 'SELECT id, content, summary FROM %s WHERE id > %%s ORDER BY id LIMIT %%s' % qn(table)
+    update = 'UPDATE %s SET content = %%s, summary = %%s WHERE id = %%s' % qn(table)
+    before = after = 0
+    last = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(select, [last, chunk_size])
+            rows = cursor.fetchall()
+            if not rows:
+                return before, after
+            changed = []
+            for pk, stored, summary in rows:
+                text = unpack(stored)
+                packed = text if inflate else pack(text, connection.vendor)
+                before += _size(stored)
+                after += _size(packed)
+                if packed != stored or summary != summarize(text):
+                    changed.append([packed, summarize(text), pk])
+            if changed:
+                cursor.executemany(update, changed)
+            last = rows[-1][0]
+
+def _size(value):
+    return len(value) if isinstance(value, (bytes, memoryview)) else len(value.encode())
@@ -0,0 +1,132 @@
+from collections import Counter
+from itertools import islice
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from .models import Article, ArticleStats, AuthorStats, Comment, CommenterStats
+
+# Denormalized counters behind the stats endpoints. Every API path that
+# creates or deletes articles or comments calls created() or deleting() in
+# the transaction making the change, and each distinct counter row costs one
+# UPDATE with F(), however large the batch. Writes made outside the API
+# (the admin, deleting users, the ORM directly) are not counted; rebuild()
+# recounts everything.
+
+def _add(model, key, **deltas):
+    values = {name: F(name) + delta for name, delta in deltas.items()}
+    if model.objects.filter(**key).update(**values):
+        return
+    if min(deltas.values()) < 0:
+        # A missing row has nothing to take from; the drift waits for a rebuild.
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **deltas)
+    except IntegrityError:
+        # Another transaction created the row since the update.
+        model.objects.filter(**key).update(**values)
+
+def _grouped(queryset, *fields):
+    return queryset.order_by().values_list(*fields).annotate(Count('pk'))
+
+def _count_comments(pairs, sign):
+    """Adds sign times the {(article_id, author_id): count} comments to every counter."""
+    articles, authors = Counter(), Counter()
+    for (article_id, author_id), count in pairs.items():
+        _add(CommenterStats, {'article_id': article_id, 'author_id': author_id}, comments=sign * count)
+        articles[article_id] += count
+        authors[author_id] += count
+    for article_id, count in articles.items():
+        _add(ArticleStats, {'article_id': article_id}, comments=sign * count)
+    for author_id, count in authors.items():
+        _add(AuthorStats, {'user_id': author_id}, comments=sign * count)
+    if sign < 0 and articles:
+        CommenterStats.objects.filter(article_id__in=list(articles), comments__lte=0).delete()
+
+def created(model, objs):
+    """Counts newly saved articles or comments."""
+    if model is Article:
+        for author_id, count in Counter(obj.author_id for obj in objs).items():
+            _add(AuthorStats, {'user_id': author_id}, articles=count)
+    else:
+        _count_comments(Counter((obj.article_id, obj.author_id) for obj in objs), 1)
+
+def deleting(queryset):
+    """Uncounts the rows of queryset, and the comments of its articles; call before deleting them."""
+    if queryset.model is Article:
+        for author_id, count in _grouped(queryset, 'author_id'):
+            _add(AuthorStats, {'user_id': author_id}, articles=-count)
+        for author_id, count in _grouped(Comment.objects.filter(article__in=queryset), 'author_id'):
+            _add(AuthorStats, {'user_id': author_id}, comments=-count)
+        # Soft-deleted articles linger until purged; their stats go now.
+        ArticleStats.objects.filter(article__in=queryset).delete()
+        CommenterStats.objects.filter(article__in=queryset).delete()
+    else:
+        _count_comments({(article_id, author_id): count for article_id, author_id, count
+                         in _grouped(queryset, 'article_id', 'author_id')}, -1)
+
+def imported(model, low, high):
+    """
+    Counts the articles or comments with ids low to high, all just
+    imported, with grouped queries rather than one update per counter row.
+    Imported comments belong to imported articles, which have no per-article
+    counter rows yet, so those are inserted in bulk.
+    """
+    queryset = model.objects.filter(pk__gte=low, pk__lte=high)
+    field = 'articles' if model is Article else 'comments'
+    for author_id, count in _grouped(queryset, 'author_id'):
+        _add(AuthorStats, {'user_id': author_id}, **{field: count})
+    if model is Comment:
+        _insert(ArticleStats, ('article_id',), _grouped(queryset, 'article_id'))
+        _insert(CommenterStats, ('article_id', 'author_id'), _grouped(queryset, 'article_id', 'author_id'))
+
+def _insert(model, keys, rows, batch_size=1000):
+    rows = rows.iterator()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        model.objects.bulk_create(model(comments=row[-1], **dict(zip(keys, row))) for row in batch)
+
+def get_top(request):
+    """Returns the ?top= number of commenters to list. Raises ValueError on bad values."""
+    max_top = getattr(settings, 'BLOG_MAX_TOP_COMMENTERS', 20)
+    top = int(request.GET.get('top', 5))
+    if top < 0:
+        raise ValueError('top must not be negative')
+    return min(top, max_top)
+
+def top_commenters(article_id, limit):
+    """Returns [(author_id, comments)] for the article's most frequent commenters, from one index range."""
+    queryset = CommenterStats.objects.filter(article_id=article_id).order_by('-comments', 'author_id')
+    return list(queryset.values_list('author_id', 'comments')[:limit])
+
+def rebuild():
+    """
+    Recounts every counter from the articles and comments in one
+    transaction. Returns {model name: rows that were wrong or missing or
+    should not have existed}.
+    """
+    with transaction.atomic():
+        return {model.__name__: _recount(model, *args) for model, *args in _expected()}
+
+def _expected():
+    authors = {}
+    for author_id, count in _grouped(Article.objects.all(), 'author_id'):
+        authors[(author_id,)] = (count, 0)
+    for author_id, count in _grouped(Comment.objects.all(), 'author_id'):
+        authors[(author_id,)] = (authors.get((author_id,), (0, 0))[0], count)
+    yield AuthorStats, authors, ('user_id',), ('articles', 'comments')
+    yield ArticleStats, {(article_id,): (count,) for article_id, count in _grouped(Comment.objects.all(), 'article_id')}, \
+        ('article_id',), ('comments',)
+    yield CommenterStats, {(article_id, author_id): (count,) for article_id, author_id, count
+                           in _grouped(Comment.objects.all(), 'article_id', 'author_id')}, \
+        ('article_id', 'author_id'), ('comments',)
+
+def _recount(model, rows, keys, fields):
+    """Replaces model's rows with rows, {key values: field values}. Returns how many differed."""
+    current = {row[:len(keys)]: row[len(keys):] for row in model.objects.values_list(*keys + fields)}
+    wrong = sum(current.get(key) != values for key, values in rows.items()) + len(current.keys() - rows.keys())
+    model.objects.all().delete()
+    model.objects.bulk_create(model(**dict(zip(keys + fields, key + values))) for key, values in rows.items())
+    return wrong
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.db import connections
+from .content import unpack
+
+# Connection setup for the database profiles in settings.py. SQLite
+# connections get BLOG_SQLITE_PRAGMAS and a blog_inflate() function, for
+# SQL that reads compressed bodies, such as migration 0010, as they
+# open. No trigger or view relies on it, since other tools' connections
+# lack it. Persistent connections (CONN_MAX_AGE) are checked at the start
+# of each request so a server-side disconnect costs a reconnect instead of
+# a failed request.
+
+def apply_pragmas(sender, connection, **kwargs):
+    """connection_created receiver."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'BLOG_SQLITE_PRAGMAS', {}).items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    connection.connection.create_function('blog_inflate', 1, unpack, deterministic=True)
+
+def check_connections(**kwargs):
+    """request_started receiver."""
+    if not getattr(settings, 'BLOG_DB_HEALTH_CHECKS', True):
+        return
+    for connection in connections.all():
+        if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connections
+from django.http import StreamingHttpResponse
+from django.utils.module_loading import import_string
+
+# Server-sent events. A Hub holds this process's subscribers per channel
+# (an article id, for the comment stream). Writers publish channels after
+# commit through the BLOG_EVENTS_BACKEND: LocalBackend notifies this
+# process's hubs directly, and BrokerBackend relays through a
+# blog_event_broker so every worker connected to it is notified. A
+# notified hub fetches what changed once and hands it to each subscriber.
+# Subscribers stream from a thread under WSGI, and from the event loop
+# under myblog.asgi, where an idle subscriber costs a socket, not a thread.
+# Streams holding a thread are capped apart, at a fraction of the worker
+# threads, so they cannot take every thread from other requests.
+
+RETRY = b'retry: 3000\n\n'
+HEARTBEAT = b': heartbeat\n\n'
+
+logger = logging.getLogger(__name__)
+
+class HubFull(Exception):
+    pass
+
+_hubs = {}
+
+def encode(entry):
+    return ('id: %d\nevent: %s\ndata: %s\n\n' % (
+        entry['seq'], entry['action'], json.dumps(entry, cls=DjangoJSONEncoder))).encode()
+
+class Subscription:
+    def __init__(self, hub, channel, cursor, threaded):
+        self.hub = hub
+        self.channel = channel
+        self.cursor = cursor
+        self.threaded = threaded
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.ready = threading.Event()
+        self.loop = None
+        self.async_ready = None
+
+    def deliver(self, entries):
+        """Queues the entries past the cursor and wakes the stream. Called from any thread."""
+        wake = self.queue([(entry['seq'], encode(entry)) for entry in entries])
+        if wake is not None:
+            wake.loop.call_soon_threadsafe(wake.async_ready.set)
+
+    def queue(self, messages):
+        """
+        Queues the (seq, encoded event) messages past the cursor. Returns
+        self if the stream waits on an event loop, for the caller to wake.
+        """
+        with self.lock:
+            fresh = [message for message in messages if message[0] > self.cursor]
+            if not fresh:
+                return None
+            self.cursor = fresh[-1][0]
+            self.pending.extend(body for seq, body in fresh)
+            if self.loop is not None:
+                return self
+        self.ready.set()
+        return None
+
+    def take(self):
+        with self.lock:
+            messages = list(self.pending)
+            self.pending.clear()
+        return messages
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __iter__(self):
+        yield RETRY
+        while True:
+            self.ready.clear()
+            messages = self.take()
+            if messages:
+                yield b''.join(messages)
+            elif not self.ready.wait(getattr(settings, 'BLOG_EVENTS_HEARTBEAT', 15)):
+                yield HEARTBEAT
+
+    async def stream(self):
+        """The same events as iterating, waiting on the running event loop instead of a thread."""
+        with self.lock:
+            self.loop = asyncio.get_event_loop()
+            self.async_ready = asyncio.Event()
+        yield RETRY
+        while True:
+            self.async_ready.clear()
+            messages = self.take()
+            if messages:
+                yield b''.join(messages)
+                continue
+            try:
+                await asyncio.wait_for(self.async_ready.wait(), getattr(settings, 'BLOG_EVENTS_HEARTBEAT', 15))
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+
+class Hub:
+    """
+    fetch(channel, since) returns the entries (dicts with a 'seq') of the
+    channel after since, in order.
+    """
+
+    def __init__(self, name, fetch):
+        self.name = name
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.reset()
+        _hubs[name] = self
+
+    def reset(self):
+        """Zeroes the counters; subscribers stay."""
+        with self.lock:
+            subscriptions = [subscription for channel in self.channels.values() for subscription in channel]
+            self.stats = {'subscribers': len(subscriptions), 'rejected': 0, 'notified': 0,
+                          'threaded': sum(subscription.threaded for subscription in subscriptions)}
+
+    def subscribe(self, channel, cursor, threaded=True):
+        """
+        Raises HubFull past BLOG_EVENTS_MAX_SUBSCRIBERS in this process, or
+        for a threaded subscription (one streamed from a worker thread, not
+        the event loop), past BLOG_EVENTS_MAX_THREADED_SUBSCRIBERS.
+        """
+        with self.lock:
+            if self.stats['subscribers'] >= getattr(settings, 'BLOG_EVENTS_MAX_SUBSCRIBERS', 10000) or (
+                    threaded and self.stats['threaded'] >= getattr(settings, 'BLOG_EVENTS_MAX_THREADED_SUBSCRIBERS', 8)):
+                self.stats['rejected'] += 1
+                raise HubFull
+            subscription = Subscription(self, channel, cursor, threaded)
+            self.channels.setdefault(channel, set()).add(subscription)
+            self.stats['subscribers'] += 1
+            self.stats['threaded'] += threaded
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.channels.get(subscription.channel, set())
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self.stats['subscribers'] -= 1
+                self.stats['threaded'] -= subscription.threaded
+                if not subscriptions:
+                    del self.channels[subscription.channel]
+
+    def publish(self, channels):
+        backend().publish(self.name, sorted(set(channels)))
+
+    def notify(self, channel):
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+            self.stats['notified'] += 1
+        if not subscriptions:
+            return
+        entries = self.fetch(channel, min(subscription.cursor for subscription in subscriptions))
+        # Encoded once for everyone, and one wake-up per event loop.
+        messages = [(entry['seq'], encode(entry)) for entry in entries]
+        waiting = {}
+        for subscription in subscriptions:
+            wake = subscription.queue(messages)
+            if wake is not None:
+                waiting.setdefault(wake.loop, []).append(wake.async_ready)
+        for loop, events in waiting.items():
+            loop.call_soon_threadsafe(_set_all, events)
+
+def _set_all(events):
+    for event in events:
+        event.set()
+
+def streams_on_event_loop(request):
+    """Whether the server streams async_content on its event loop (myblog.asgi)."""
+    return bool(request.META.get('blog.async_content'))
+
+def stream_response(subscription):
+    # The subscription is closed, and leaves the hub, with the response.
+    response = StreamingHttpResponse(subscription, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    # Picked up by myblog.asgi to stream on the event loop.
+    response.async_content = subscription.stream
+    return response
+
+class LocalBackend:
+    def publish(self, hub, channels):
+        for channel in channels:
+            _hubs[hub].notify(channel)
+
+class BrokerBackend:
+    """
+    Sends "<hub> <channel>" lines to the blog_event_broker at
+    BLOG_EVENTS_BROKER, which echoes them to every connected worker, this
+    one included. While the broker is unreachable, only this process's
+    subscribers hear of its writes.
+    """
+
+    def __init__(self):
+        self.address = tuple(getattr(settings, 'BLOG_EVENTS_BROKER', ('127.0.0.1', 7390)))
+        self.lock = threading.Lock()
+        self.sock = None
+        self.connected = threading.Event()
+        threading.Thread(target=self.listen, name='blog-events', daemon=True).start()
+
+    def publish(self, hub, channels):
+        message = ''.join('%s %s\n' % (hub, channel) for channel in channels).encode()
+        with self.lock:
+            sock = self.sock
+            if sock is not None:
+                try:
+                    sock.sendall(message)
+                    return
+                except OSError:
+                    pass
+        LocalBackend().publish(hub, channels)
+
+    def listen(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.address)
+            except OSError:
+                time.sleep(1)
+                continue
+            with self.lock:
+                self.sock = sock
+            self.connected.set()
+            try:
+                for line in sock.makefile('rb'):
+                    self.receive(line)
+            except OSError:
+                pass
+            finally:
+                self.connected.clear()
+                with self.lock:
+                    self.sock = None
+                sock.close()
+            time.sleep(1)
+
+    def receive(self, line):
+        name, _, channel = line.decode().strip().partition(' ')
+        if name not in _hubs:
+            return
+        # This thread keeps its own database connection between messages.
+        close_old_connections()
+        try:
+            _hubs[name].notify(int(channel))
+        except Exception:
+            # One failed fetch must not stop the notifications; the next
+            # one for the channel fetches from the same cursor, on a fresh
+            # connection in case this one was what failed.
+            logger.exception('Notifying %s of channel %s failed', name, channel)
+            connections.close_all()
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def backend():
+    path = getattr(settings, 'BLOG_EVENTS_BACKEND', 'blog.events.LocalBackend')
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
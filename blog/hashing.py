@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.http import HttpResponse
+
+# Password hashing off the request threads. PBKDF2 runs on a small pool of
+# BLOG_HASH_WORKERS threads (hashlib releases the GIL while it iterates)
+# behind a bounded queue, and each endpoint that hashes holds one of its
+# BLOG_HASH_CONCURRENCY slots while it does. Both refuse work instead of
+# waiting once full, so a login storm cannot tie up every request thread.
+# The pooled hasher is the project's default, so any view may be refused;
+# HashingBusyMiddleware answers those with the same 503 as signup/signin.
+
+class HashingBusy(Exception):
+    pass
+
+def service_unavailable():
+    response = HttpResponse(status=503)
+    response['Retry-After'] = getattr(settings, 'BLOG_HASH_RETRY_AFTER', 1)
+    return response
+
+class HashingPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.workers = 0
+        self.pending = 0
+        self.in_use = {}
+        self.reset()
+
+    def reset(self):
+        """Zeroes the counters."""
+        with self.lock:
+            self.stats = {'hashes': 0, 'hash_seconds': 0.0, 'queue_depth': 0, 'max_queue_depth': 0, 'rejected': 0}
+
+    def get_executor(self):
+        if self.executor is None:
+            self.workers = getattr(settings, 'BLOG_HASH_WORKERS', None) or os.cpu_count() or 1
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hash')
+        return self.executor
+
+    def run(self, func, *args):
+        """Returns func(*args) computed on the pool. Raises HashingBusy if the queue is full."""
+        with self.lock:
+            executor = self.get_executor()
+            if self.pending >= self.workers + getattr(settings, 'BLOG_HASH_QUEUE_SIZE', 16):
+                self.stats['rejected'] += 1
+                raise HashingBusy
+            self.pending += 1
+            self.update_depth()
+        try:
+            return executor.submit(self.timed, func, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.update_depth()
+
+    def update_depth(self):
+        depth = max(self.pending - self.workers, 0)
+        self.stats['queue_depth'] = depth
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], depth)
+
+    def timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stats['hashes'] += 1
+                self.stats['hash_seconds'] += elapsed
+
+    @contextmanager
+    def slot(self, endpoint):
+        """Holds one of endpoint's concurrency slots. Raises HashingBusy if none is free."""
+        limit = getattr(settings, 'BLOG_HASH_CONCURRENCY', {}).get(endpoint)
+        with self.lock:
+            if limit is not None and self.in_use.get(endpoint, 0) >= limit:
+                self.stats['rejected'] += 1
+                raise HashingBusy
+            self.in_use[endpoint] = self.in_use.get(endpoint, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_use[endpoint] -= 1
+
+hashing_pool = HashingPool()
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """Django's PBKDF2 hasher, computed on hashing_pool. Stored hashes are unchanged."""
+
+    def encode(self, password, salt, iterations=None):
+        return hashing_pool.run(super().encode, password, salt, iterations)
@@ -0,0 +1,111 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .conditional import last_modified
+from .models import Comment
+from .content import unpack
+from .serializers import comment_serializer, wants_summary
+
+# Related data embedded in article list pages, so clients need not call
+# the comment endpoint once per article. Each include costs one query for
+# the whole page, however many articles it holds.
+
+class ArticleIncludes:
+    def __init__(self, comment_count=False, recent_comments=0, summary=False):
+        self.comment_count = comment_count
+        self.recent_comments = recent_comments
+        self.summary = summary
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Parses ?include=comment_count,recent_comments=K. Returns None when
+        nothing is included; raises ValueError on anything unknown.
+        """
+        requested = request.GET.get('include')
+        if not requested:
+            return None
+        includes = cls(summary=wants_summary(request))
+        for name in requested.split(','):
+            name, _, value = name.strip().partition('=')
+            if name == 'comment_count' and not value:
+                includes.comment_count = True
+            elif name == 'recent_comments':
+                limit = int(value) if value else 1
+                if limit < 1:
+                    raise ValueError('recent_comments must be positive')
+                includes.recent_comments = min(limit, getattr(settings, 'BLOG_MAX_RECENT_COMMENTS', 20))
+            else:
+                raise ValueError('unknown include')
+        return includes
+
+    def validators(self):
+        # Included data changes with any comment, not just with the articles.
+        return [last_modified(Comment)]
+
+    def expand(self, ids, articles):
+        """Adds the included data to the article dicts, matched up with ids."""
+        if self.comment_count:
+            counts = dict(Comment.objects.filter(article_id__in=ids).order_by()
+                          .values_list('article_id').annotate(Count('pk')))
+            for pk, article in zip(ids, articles):
+                article['comment_count'] = counts.get(pk, 0)
+        if self.recent_comments:
+            recent = {pk: [] for pk in ids}
+            for comment in recent_comments(ids, self.recent_comments, self.summary):
+                recent[comment['article']].append(comment)
+            for pk, article in zip(ids, articles):
+                article['recent_comments'] = recent[pk]
+
+def supports_window(connection):
+    if connection.vendor == 'sqlite':
+        # Django 2.2 never enables window functions on SQLite, though
+        # SQLite has had them since 3.25.
+        return connection.Database.sqlite_version_info >= (3, 25, 0)
+    return connection.features.supports_over_clause
+
+def recent_comments(article_ids, limit, summary=False):
+    """
+    Returns the newest limit comments of each article, newest first, in one
+    query; with summary, with their summaries instead of their bodies.
+    """
+    if not article_ids:
+        return []
+    fields = comment_serializer.all_fields
+    if summary:
+        fields = comment_serializer.summarized(fields)
+    to_dict = comment_serializer.row(fields)
+    queryset = Comment.objects.filter(article_id__in=article_ids)
+    connection = connections[queryset.db]
+    if not supports_window(connection):
+        newer = (Comment.objects.filter(article_id=OuterRef('article_id'), pk__gt=OuterRef('pk'))
+                 .order_by().values('article_id').annotate(count=Count('pk')).values('count'))
+        queryset = (queryset.annotate(newer=Coalesce(Subquery(newer, output_field=IntegerField()), 0))
+                    .filter(newer__lt=limit).order_by('article_id', '-pk'))
+        return [to_dict(row) for row in queryset.values_list(*fields)]
+
+    qn = connection.ops.quote_name
+    meta = Comment._meta
+    sql = (
+        'SELECT {columns} FROM ('
+        'SELECT {columns}, ROW_NUMBER() OVER (PARTITION BY {article} ORDER BY {id} DESC) AS {rank} '
+        'FROM {table} WHERE {article} IN ({ids}) AND {deleted} IS NULL'
+        ') ranked WHERE {rank} <= %s ORDER BY {article}, {rank}'
+    ).format(
+        columns=', '.join(qn(meta.get_field(name).column) for name in fields),
+        article=qn(meta.get_field('article').column),
+        id=qn(meta.pk.column),
+        rank=qn('recent_rank'),
+        table=qn(meta.db_table),
+        deleted=qn(meta.get_field('deleted_at').column),
+        ids=', '.join(['%s'] * len(article_ids)),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(article_ids) + [limit])
+        rows = cursor.fetchall()
+    if 'content' in fields:
+        # Raw rows hold bodies as stored.
+        index = fields.index('content')
+        rows = [row[:index] + (unpack(row[index]),) + row[index + 1:] for row in rows]
+    return [to_dict(row) for row in rows]
@@ -0,0 +1,485 @@
+import copy
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished
+from django.db import close_old_connections, connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+QUERIES = re.compile(r'(\d+) queries')
+
+
+def first_events(read):
+    """
+    Reads an event stream, which never ends, through the retry line and
+    the first message after it (the backlog, or a heartbeat).
+    """
+    body = b''
+    while body.count(b'\n\n') < 2:
+        chunk = read()
+        if not chunk:
+            break
+        body += chunk
+    return body
+
+
+class InProcessClient:
+    """Sends requests straight to the Django handler in this process."""
+
+    def __init__(self, cookies):
+        self.client = Client()
+        self.client.cookies = cookies
+
+    @property
+    def cookies(self):
+        return self.client.cookies
+
+    @cookies.setter
+    def cookies(self, cookies):
+        self.client.cookies = cookies
+
+    def request(self, method, path, data=None, headers=None):
+        """Returns (status, Server-Timing header, body) for a path below /api."""
+        extra = {'HTTP_' + name.upper().replace('-', '_'): value for name, value in (headers or {}).items()}
+        if data is not None:
+            extra.update(data=json.dumps(data), content_type='application/json')
+        response = getattr(self.client, method.lower())('/api' + path, **extra)
+        if response.get('Content-Type') == 'text/event-stream':
+            body = first_events(lambda: next(response.streaming_content, b''))
+            # As the test client does once a body is read, without closing
+            # this thread's database connection.
+            request_finished.disconnect(close_old_connections)
+            try:
+                response.close()
+            finally:
+                request_finished.connect(close_old_connections)
+        elif response.streaming:
+            body = b''.join(response.streaming_content)
+        else:
+            body = response.content
+        return response.status_code, response.get('Server-Timing', ''), body
+
+
+class HTTPClient:
+    """Sends requests to a running server over one kept-alive connection."""
+
+    def __init__(self, base_url, cookies):
+        url = urlsplit(base_url)
+        self.host, self.port, self.prefix = url.hostname, url.port or 80, url.path.rstrip('/')
+        self.cookies = cookies
+        self.connection = None
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % (name, morsel.value) for name, morsel in self.cookies.items())
+        if 'csrftoken' in self.cookies:
+            headers['X-CSRFToken'] = self.cookies['csrftoken'].value
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                if response.getheader('Content-Type') == 'text/event-stream':
+                    content = first_events(lambda: response.read1(65536))
+                    # The stream is still open; only a new connection is reusable.
+                    self.connection.close()
+                    self.connection = None
+                else:
+                    content = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the kept-alive connection; reconnect once.
+                self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    raise
+        for header in response.msg.get_all('Set-Cookie') or []:
+            self.cookies.load(header)
+        return response.status, response.getheader('Server-Timing', ''), content
+
+
+class Command(BaseCommand):
+    help = ('Seeds users, articles and comments through the blog API, then drives every '
+            'route at the given concurrency and reports throughput, latency percentiles, '
+            'queries per request and peak memory. Runs in process against a scratch '
+            'database unless --url names a running server. Results can be written as '
+            'JSON and checked against an earlier run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--articles', type=int, default=200, help='Articles per user.')
+        parser.add_argument('--comments', type=int, default=5, help='Comments per article.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per route.')
+        parser.add_argument('--auth-requests', type=int, default=20,
+                            help='Requests per route for the routes that hash a password.')
+        parser.add_argument('--concurrency', type=int, default=4, help='Client threads.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for choosing request targets.')
+        parser.add_argument('--route', action='append', dest='routes', help='Route to run; repeatable.')
+        parser.add_argument('--url', help='Base URL of a running server, e.g. http://127.0.0.1:8000/api')
+        parser.add_argument('--metrics-token', help="The server's BLOG_METRICS_TOKEN, to include /_metrics with --url.")
+        parser.add_argument('--current-db', action='store_true',
+                            help='Run in process against the configured database instead of a scratch one.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Fail if worse than the results in this JSON file.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Tolerated relative drop in throughput or rise in p95 against --baseline.')
+
+    def handle(self, *args, **options):
+        for name in ('users', 'articles', 'requests', 'auth_requests', 'concurrency'):
+            if options[name] < 1:
+                raise CommandError('--%s must be positive' % name.replace('_', '-'))
+        self.options = options
+        self.random = random.Random(options['seed'])
+        if options['url']:
+            self.metrics_token = options['metrics_token']
+            results = self.run()
+        else:
+            self.metrics_token = 'blog_bench'
+            # Every client shares one address, so the rate limits would
+            # measure the 429 path; a server under --url keeps its own.
+            with override_settings(ALLOWED_HOSTS=['*'], BLOG_METRICS_TOKEN=self.metrics_token, BLOG_RATE_LIMITS={}):
+                if options['current_db']:
+                    results = self.run()
+                else:
+                    results = self.run_on_scratch_database()
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                self.compare(json.load(baseline)['routes'], results['routes'])
+
+    def run_on_scratch_database(self):
+        directory = tempfile.mkdtemp(prefix='blog_bench')
+        for connection in connections.all():
+            if connection.vendor == 'sqlite':
+                # A file rather than SQLite's in-memory test database, so the
+                # client threads' connections see each other's commits.
+                test = dict(connection.settings_dict.get('TEST') or {})
+                test['NAME'] = os.path.join(directory, '%s.sqlite3' % connection.alias)
+                connection.settings_dict['TEST'] = test
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            return self.run()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def client(self, cookies):
+        if self.options['url']:
+            return HTTPClient(self.options['url'], cookies)
+        return InProcessClient(cookies)
+
+    def call(self, cookies, method, path, data=None, expected=200):
+        """Sends a setup request and returns its decoded body."""
+        status, timing, body = self.client(cookies).request(method, path, data)
+        if status != expected:
+            raise CommandError('%s %s returned %d while preparing' % (method, path, status))
+        return json.loads(body.decode()) if body else None
+
+    def run(self):
+        routes = self.routes()
+        names = [route[0] for route in routes]
+        unknown = set(self.options['routes'] or ()) - set(names)
+        if unknown:
+            raise CommandError('unknown route(s): %s' % ', '.join(sorted(unknown)))
+        started = time.time()
+        self.seed()
+        results = {}
+        for name, count, expected, prepare in routes:
+            if name in (self.options['routes'] or names):
+                results[name] = self.drive([prepare(index) for index in range(count)], expected)
+        return {
+            'meta': {
+                'commit': self.commit(),
+                'started': started,
+                'mode': 'http' if self.options['url'] else 'in-process',
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'users': self.options['users'],
+                'articles_per_user': self.options['articles'],
+                'comments_per_article': self.options['comments'],
+                'concurrency': self.options['concurrency'],
+                'seed': self.options['seed'],
+            },
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+            'routes': results,
+        }
+
+    def commit(self):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip() or None
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def seed(self):
+        """Creates the dataset through the API; each user comments round-robin on every article."""
+        self.prefix = 'bench%x' % int(time.time() * 1000)
+        self.sessions = []
+        self.user_ids = {}
+        for user in range(self.options['users']):
+            self.sessions.append(self.signed_in(self.username(user), signup=True))
+        self.articles = [self.bulk_create(user, '/article/bulk/', [
+            {'title': 'bench %d %d' % (user, number), 'content': self.text(number)}
+            for number in range(self.options['articles'])]) for user in range(self.options['users'])]
+        every_article = [pk for owned in self.articles for pk in owned]
+        planned = [[] for _ in self.sessions]
+        for number in range(len(every_article) * self.options['comments']):
+            planned[number % len(self.sessions)].append(
+                {'article': every_article[number // self.options['comments']], 'content': self.text(number)})
+        self.comments = [self.bulk_create(user, '/comment/bulk/', items) for user, items in enumerate(planned)]
+
+    def username(self, user):
+        return '%s-%s' % (self.prefix, user)
+
+    def signed_in(self, username, signup=False):
+        cookies = SimpleCookie()
+        credentials = {'username': username, 'password': 'blog_bench'}
+        self.call(cookies, 'GET', '/token/', expected=204)
+        if signup:
+            self.call(cookies, 'POST', '/signup/', credentials, expected=201)
+        self.call(cookies, 'POST', '/signin/', credentials, expected=204)
+        return cookies
+
+    def text(self, number):
+        return ' '.join('word%d' % ((number * 7 + offset) % 97) for offset in range(20))
+
+    def bulk_create(self, user, path, items):
+        pks = []
+        size = getattr(settings, 'BLOG_BULK_MAX_ITEMS', 1000)
+        for start in range(0, len(items), size):
+            results = self.call(self.sessions[user], 'POST', path, items[start:start + size])
+            pks += [result['data']['id'] for result in results if result['status'] == 201]
+            self.user_ids[user] = results[0]['data']['author']
+        return pks
+
+    def spares(self, kind, count):
+        """Creates count throwaway articles or comments per user for the delete routes."""
+        if kind == 'article':
+            return [self.bulk_create(user, '/article/bulk/', [{'title': 'spare', 'content': 'spare'}] * count)
+                    for user in range(len(self.sessions))]
+        return [self.bulk_create(user, '/comment/bulk/', [{'article': self.articles[user][0], 'content': 'spare'}] * count)
+                for user in range(len(self.sessions))]
+
+    def routes(self):
+        """
+        Returns (name, requests, expected status, prepare) for every route.
+        prepare(index) returns (cookies, method, path, body, headers) for
+        one request, doing any setup that should not be timed.
+        """
+        count = self.options['requests']
+        auth_count = self.options['auth_requests']
+        users = self.options['users']
+        pick = self.random.choice
+        lazy = {}
+
+        def spare(kind, user):
+            if kind not in lazy:
+                lazy[kind] = self.spares(kind.split('_')[0], -(-count // users) * (10 if 'bulk' in kind else 1))
+            return lazy[kind][user].pop()
+
+        def sample(owned):
+            return self.random.sample(owned, min(len(owned), 10))
+
+        def owner(index):
+            return index % users
+
+        def any_article():
+            return pick(pick(self.articles))
+
+        def any_comment():
+            return pick(pick(self.comments))
+
+        def request(user, method, path, data=None, headers=None):
+            return self.sessions[user], method, path, data, headers
+
+        def anonymous():
+            # With a CSRF cookie, which a server requires before any POST.
+            cookies = SimpleCookie()
+            self.call(cookies, 'GET', '/token/', expected=204)
+            return cookies
+
+        routes = [
+            ('token', count, 204, lambda i: (SimpleCookie(), 'GET', '/token/', None, None)),
+            ('signup', auth_count, 201, lambda i: (anonymous(), 'POST', '/signup/',
+                                                   {'username': '%s-new-%d' % (self.prefix, i), 'password': 'blog_bench'}, None)),
+            ('signin', auth_count, 204, lambda i: (anonymous(), 'POST', '/signin/',
+                                                   {'username': self.username(owner(i)), 'password': 'blog_bench'}, None)),
+            ('signout', auth_count, 204, lambda i: (self.signed_in(self.username(owner(i))), 'GET', '/signout/', None, None)),
+            ('article_list', count, 200, lambda i: request(owner(i), 'GET', '/article/')),
+            ('article_list_include', count, 200, lambda i: request(
+                owner(i), 'GET', '/article/?include=comment_count,recent_comments=3')),
+            ('article_list_stream', max(count // 20, 1), 200, lambda i: request(owner(i), 'GET', '/article/?stream=1')),
+            ('article_create', count, 201, lambda i: request(owner(i), 'POST', '/article/', {'title': 'new', 'content': 'new'})),
+            ('article_detail', count, 200, lambda i: request(owner(i), 'GET', '/article/%d/' % any_article())),
+            ('article_update', count, 201, lambda i: request(owner(i), 'PUT', '/article/%d/' % pick(self.articles[owner(i)]),
+                                                             {'title': 'updated', 'content': self.text(i)})),
+            ('article_delete', count, 200, lambda i: request(owner(i), 'DELETE', '/article/%d/' % spare('article', owner(i)))),
+            ('article_comment_list', count, 200, lambda i: request(owner(i), 'GET', '/article/%d/comment/' % any_article())),
+            ('article_comment_create', count, 201, lambda i: request(
+                owner(i), 'POST', '/article/%d/comment/' % any_article(), {'content': 'new'})),
+            ('comment_detail', count, 200, lambda i: request(owner(i), 'GET', '/comment/%d/' % any_comment())),
+            ('comment_update', count, 201, lambda i: request(owner(i), 'PUT', '/comment/%d/' % pick(self.comments[owner(i)]),
+                                                             {'content': self.text(i)})),
+            ('comment_delete', count, 200, lambda i: request(owner(i), 'DELETE', '/comment/%d/' % spare('comment', owner(i)))),
+            ('article_bulk_create', count, 200, lambda i: request(owner(i), 'POST', '/article/bulk/',
+                                                                  [{'title': 'bulk', 'content': 'bulk'}] * 10)),
+            ('article_bulk_update', count, 200, lambda i: request(owner(i), 'PUT', '/article/bulk/', [
+                {'id': pk, 'title': 'bulk', 'content': 'bulk'} for pk in sample(self.articles[owner(i)])])),
+            ('article_bulk_delete', count, 200, lambda i: request(owner(i), 'DELETE', '/article/bulk/',
+                                                                  [spare('article_bulk', owner(i)) for _ in range(10)])),
+            ('comment_bulk_create', count, 200, lambda i: request(owner(i), 'POST', '/comment/bulk/',
+                                                                  [{'article': any_article(), 'content': 'bulk'}] * 10)),
+            ('comment_bulk_update', count, 200, lambda i: request(owner(i), 'PUT', '/comment/bulk/', [
+                {'id': pk, 'content': 'bulk'} for pk in sample(self.comments[owner(i)])])),
+            ('comment_bulk_delete', count, 200, lambda i: request(owner(i), 'DELETE', '/comment/bulk/',
+                                                                  [spare('comment_bulk', owner(i)) for _ in range(10)])),
+            ('article_comment_stream', count, 200, lambda i: request(
+                owner(i), 'GET', '/article/%d/comment/stream/' % any_article(), headers={'Last-Event-ID': '0'})),
+            ('article_stats', count, 200, lambda i: request(owner(i), 'GET', '/article/%d/stats/' % any_article())),
+            ('user_stats', count, 200, lambda i: request(owner(i), 'GET', '/user/%d/stats/' % self.user_ids[pick(range(users))])),
+            ('changes', count, 200, lambda i: request(owner(i), 'GET', '/changes/?since=%d&limit=100' % (i * 10))),
+            ('search', count, 200, lambda i: request(owner(i), 'GET', '/search/?q=word%d' % (i % 97))),
+        ]
+        if self.metrics_token:
+            routes.append(('metrics', count, 200, lambda i: (SimpleCookie(), 'GET', '/_metrics', None,
+                                                             {'Authorization': 'Bearer ' + self.metrics_token})))
+        return routes
+
+    def drive(self, requests, expected):
+        """Sends requests from the client threads and summarizes them."""
+        latencies = []
+        queries = []
+        errors = []
+        rejected = []
+        failures = []
+        lock = threading.Lock()
+        pending = iter(enumerate(requests))
+
+        def work():
+            # One client per thread, switched between the thread's own
+            # copies of each session's cookies.
+            client = self.client(SimpleCookie())
+            copies = {}
+            while True:
+                with lock:
+                    item = next(pending, None)
+                if item is None:
+                    break
+                index, (cookies, method, path, data, headers) = item
+                if id(cookies) not in copies:
+                    copies[id(cookies)] = copy.deepcopy(cookies)
+                client.cookies = copies[id(cookies)]
+                start = time.perf_counter()
+                try:
+                    status, timing, body = client.request(method, path, data, headers)
+                except Exception as e:
+                    # The test client re-raises view exceptions; a server
+                    # would have answered 500.
+                    status, timing = 500, ''
+                    with lock:
+                        failures.append('%s %s: %r' % (method, path, e))
+                elapsed = time.perf_counter() - start
+                match = QUERIES.search(timing)
+                with lock:
+                    latencies.append(elapsed)
+                    if match:
+                        queries.append(int(match.group(1)))
+                    if status in (429, 503):
+                        rejected.append(status)
+                    elif status != expected:
+                        errors.append(status)
+
+        def thread():
+            try:
+                work()
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        if self.options['concurrency'] == 1:
+            # In the calling thread, on its connection and transaction.
+            work()
+        else:
+            threads = [threading.Thread(target=thread) for _ in range(min(self.options['concurrency'], len(requests)))]
+            for running in threads:
+                running.start()
+            for running in threads:
+                running.join()
+        elapsed = time.perf_counter() - start
+        for failure in failures[:3]:
+            self.stderr.write(failure)
+        latencies.sort()
+        return {
+            'requests': len(requests),
+            'errors': len(errors),
+            'error_statuses': sorted(set(errors)),
+            # 429s and 503s are admission control (rate limits, the write and
+            # password hashing concurrency limits), not failures.
+            'rejected': len(rejected),
+            'throughput': len(requests) / elapsed,
+            'p50_ms': self.percentile(latencies, 0.5),
+            'p95_ms': self.percentile(latencies, 0.95),
+            'p99_ms': self.percentile(latencies, 0.99),
+            'queries': sum(queries) / len(queries) if queries else None,
+        }
+
+    def percentile(self, latencies, q):
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+
+    def report(self, results):
+        self.stdout.write('%-24s %8s %7s %8s %10s %9s %9s %9s %8s' % (
+            'route', 'requests', 'errors', 'rejected', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for name, route in results['routes'].items():
+            self.stdout.write('%-24s %8d %7d %8d %10.1f %9.2f %9.2f %9.2f %8s' % (
+                name, route['requests'], route['errors'], route['rejected'], route['throughput'], route['p50_ms'],
+                route['p95_ms'], route['p99_ms'], '-' if route['queries'] is None else '%.1f' % route['queries']))
+        if results['peak_rss_kb'] is not None:
+            self.stdout.write('peak RSS %.1f MiB' % (results['peak_rss_kb'] / 1024))
+
+    def compare(self, baseline, routes):
+        threshold = self.options['threshold']
+        regressions = []
+        for name, route in routes.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if route['errors'] > before['errors']:
+                regressions.append('%s: %d errors, was %d' % (name, route['errors'], before['errors']))
+            if route['throughput'] < before['throughput'] * (1 - threshold):
+                regressions.append('%s: %.1f req/s, was %.1f' % (name, route['throughput'], before['throughput']))
+            if route['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append('%s: p95 %.2f ms, was %.2f' % (name, route['p95_ms'], before['p95_ms']))
+            # Query counts do not depend on timing, so any increase counts.
+            if route['queries'] is not None and before['queries'] is not None and route['queries'] > before['queries'] + 0.01:
+                regressions.append('%s: %.1f queries per request, was %.1f' % (name, route['queries'], before['queries']))
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError('%d regression(s) against the baseline' % len(regressions))
+        self.stdout.write('no regressions against the baseline')
@@ -0,0 +1,29 @@
+import os
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+from blog.content import repack
+from blog.models import Article, Comment
+
+
+class Command(BaseCommand):
+    help = ('Repacks the stored article and comment bodies for the current '
+            'BLOG_COMPRESS_CONTENT_OVER, a chunk per transaction, fills in missing '
+            'summaries and reports the stored bytes before and after.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inflate', action='store_true', help='Store every body as text.')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='Then VACUUM an SQLite database to hand the space back to the disk.')
+
+    def handle(self, *args, **options):
+        for model in (Article, Comment):
+            connection = connections[router.db_for_write(model)]
+            before, after = repack(connection, model._meta.db_table, options['inflate'])
+            self.stdout.write('%s: %d -> %d bytes of bodies' % (model._meta.db_table, before, after))
+        connection = connections[router.db_for_write(Article)]
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            size = os.path.getsize(connection.settings_dict['NAME'])
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+            self.stdout.write('database file: %d -> %d bytes' % (
+                size, os.path.getsize(connection.settings_dict['NAME'])))
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from blog.models import Article, Change, Comment
+
+
+class Command(BaseCommand):
+    help = ('Runs concurrent article and comment writes, alongside list reads, through the '
+            'blog API against the configured database and reports write throughput and '
+            'lock errors. Select the database with BLOG_DB_PROFILE.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help='Writing threads.')
+        parser.add_argument('--readers', type=int, default=4, help='Threads reading the article list.')
+        parser.add_argument('--writes', type=int, default=50, help='Writes per writing thread.')
+
+    def handle(self, *args, **options):
+        if options['writers'] < 1 or options['writes'] < 1 or options['readers'] < 0:
+            raise CommandError('--writers and --writes must be positive')
+        journal = '-'
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                journal = cursor.fetchone()[0]
+        self.stdout.write('profile %s (%s, journal %s)' % (
+            getattr(settings, 'BLOG_DB_PROFILE', 'sqlite'), connection.vendor, journal))
+        user = User.objects.create_user(username='blog_db_bench', password='blog_db_bench')
+        try:
+            # Admission control would turn lock contention into 429s and 503s.
+            with override_settings(ALLOWED_HOSTS=['*'], BLOG_RATE_LIMITS={}, BLOG_WRITE_CONCURRENCY=None):
+                self.bench(user, options['writers'], options['readers'], options['writes'])
+        finally:
+            self.clean_up(user)
+
+    def clean_up(self, user):
+        # Deleting the user cascades to its articles and comments, but not
+        # to the change feed entries their writes recorded.
+        for kind, model in (('article', Article), ('comment', Comment)):
+            Change.objects.filter(kind=kind, object_id__in=model.all_objects.filter(author=user).values('pk')).delete()
+        user.delete()
+
+    def bench(self, user, writers, readers, writes):
+        client = Client()
+        client.force_login(user)
+        try:
+            self.run_threads(client, writers, readers, writes)
+        finally:
+            # Drops the session from whichever store SESSION_ENGINE names.
+            client.logout()
+
+    def run_threads(self, client, writers, readers, writes):
+        article = json.loads(client.post('/api/article/', json.dumps({'title': 'bench', 'content': 'bench'}),
+                                         content_type='application/json').content)
+        counts = {'ok': 0, 'locked': 0, 'failed': 0, 'reads': 0}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def count(key):
+            with lock:
+                counts[key] += 1
+
+        def session():
+            # Test clients are not thread-safe; each thread gets its own
+            # holding the shared session cookie.
+            own = Client()
+            own.cookies = client.cookies
+            return own
+
+        def send(own, url, data=None):
+            try:
+                if data is None:
+                    return own.get(url).status_code
+                return own.post(url, json.dumps(data), content_type='application/json').status_code
+            except OperationalError as e:
+                return 'locked' if 'locked' in str(e) else 'failed'
+
+        def write(index):
+            own = session()
+            try:
+                for number in range(writes):
+                    if number % 2:
+                        status = send(own, '/api/article/%d/comment/' % article['id'], {'content': 'bench'})
+                    else:
+                        status = send(own, '/api/article/', {'title': 'bench %d' % index, 'content': 'bench'})
+                    count({201: 'ok', 'locked': 'locked'}.get(status, 'failed'))
+            finally:
+                connections.close_all()
+
+        def read():
+            own = session()
+            try:
+                while not done.is_set():
+                    if send(own, '/api/article/?limit=20') == 200:
+                        count('reads')
+            finally:
+                connections.close_all()
+
+        reading = [threading.Thread(target=read) for _ in range(readers)]
+        writing = [threading.Thread(target=write, args=(index,)) for index in range(writers)]
+        start = time.perf_counter()
+        for thread in reading + writing:
+            thread.start()
+        for thread in writing:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        for thread in reading:
+            thread.join()
+        total = writers * writes
+        self.stdout.write('%d writes in %.2fs: %.1f writes/s, %d locked (%.1f%%), %d failed; %.1f reads/s' % (
+            total, elapsed, counts['ok'] / elapsed, counts['locked'], 100.0 * counts['locked'] / total,
+            counts['failed'], counts['reads'] / elapsed))
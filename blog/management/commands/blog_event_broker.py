@@ -0,0 +1,42 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Relays event notifications between the workers of one deployment: '
+            'every line a worker sends is echoed to every connected worker. '
+            'Workers connect when BLOG_EVENTS_BACKEND is blog.events.BrokerBackend.')
+
+    def add_arguments(self, parser):
+        host, port = getattr(settings, 'BLOG_EVENTS_BROKER', ('127.0.0.1', 7390))
+        parser.add_argument('--host', default=host)
+        parser.add_argument('--port', type=int, default=port)
+
+    def handle(self, *args, **options):
+        self.writers = set()
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.relay, options['host'], options['port']))
+        self.stdout.write('relaying on %s:%d' % (options['host'], options['port']))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.close()
+
+    async def relay(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b'\n'):
+                    break
+                for peer in list(self.writers):
+                    peer.write(line)
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
@@ -0,0 +1,133 @@
+import json
+import re
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from blog import tasks
+from blog.models import Article, Comment
+from blog.pagination import encode_cursor
+from blog.routers import primary
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Drives every blog API endpoint, and the background tasks they enqueue, '
+            'against throwaway rows and prints the query plan of each query it issues, '
+            'flagging full table scans, including scans of a whole index.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-scan', action='store_true',
+                            help='Exit with an error if any query scans a whole table.')
+
+    def handle(self, *args, **options):
+        self.scans = []
+        try:
+            with transaction.atomic(), primary(), override_settings(ALLOWED_HOSTS=['*']):
+                self.explain_endpoints()
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write('%d full table scan(s)' % len(self.scans))
+        for label, line in self.scans:
+            self.stdout.write('  %s: %s' % (label, line))
+        if self.scans and options['fail_on_scan']:
+            raise CommandError('full table scans found')
+
+    def explain_endpoints(self):
+        user = User.objects.create_user(username='blog_explain', password='blog_explain')
+        article = Article.objects.create(title='explain', content='explain', author=user)
+        comment = Comment.objects.create(article=article, content='explain', author=user)
+        client = Client()
+        client.force_login(user)
+
+        def body(data):
+            return {'data': json.dumps(data), 'content_type': 'application/json'}
+
+        requests = [
+            ('get', '/api/article/', {}),
+            ('get', '/api/article/?after=%s&limit=10' % encode_cursor(article.id), {}),
+            ('get', '/api/article/?before=%s' % encode_cursor(article.id), {}),
+            ('get', '/api/article/?include=comment_count,recent_comments=3', {}),
+            ('get', '/api/article/?summary=1&include=recent_comments=3', {}),
+            ('get', '/api/article/?stream=1', {'full_read': True}),
+            ('post', '/api/article/', body({'title': 'explain', 'content': 'explain'})),
+            ('get', '/api/article/%d/' % article.id, {}),
+            ('put', '/api/article/%d/' % article.id, body({'title': 'explain', 'content': 'explain'})),
+            ('get', '/api/article/%d/comment/' % article.id, {}),
+            ('post', '/api/article/%d/comment/' % article.id, body({'content': 'explain'})),
+            ('get', '/api/comment/%d/' % comment.id, {}),
+            ('get', '/api/search/?q=explain', {}),
+            ('get', '/api/article/%d/stats/' % article.id, {}),
+            ('get', '/api/user/%d/stats/' % user.id, {}),
+            ('get', '/api/changes/?since=0', {}),
+            ('get', '/api/article/%d/comment/stream/' % article.id, {}),
+            ('get', '/api/article/%d/comment/stream/' % article.id, {'HTTP_LAST_EVENT_ID': '0'}),
+            ('put', '/api/comment/%d/' % comment.id, body({'content': 'explain'})),
+            ('post', '/api/article/bulk/', body([{'title': 'explain', 'content': 'explain'}])),
+            ('put', '/api/article/bulk/', body([{'id': article.id, 'title': 'explain', 'content': 'explain'}])),
+            ('post', '/api/comment/bulk/', body([{'article': article.id, 'content': 'explain'}])),
+            ('put', '/api/comment/bulk/', body([{'id': comment.id, 'content': 'explain'}])),
+            ('delete', '/api/comment/bulk/', body([comment.id])),
+            ('delete', '/api/article/%d/' % article.id, {}),
+            ('delete', '/api/article/bulk/', body([article.id])),
+        ]
+        self.tables = set(connection.introspection.table_names())
+        for method, url, kwargs in requests:
+            label = '%s %s' % (method.upper(), url)
+            full_read = kwargs.pop('full_read', False)
+            with CaptureQueriesContext(connection) as captured:
+                response = getattr(client, method)(url, **kwargs)
+                if response.get('Content-Type') == 'text/event-stream':
+                    # Never ends; its queries are all made before it starts.
+                    # As the test client does once a body is read, without closing
+                    # this thread's database connection.
+                    request_finished.disconnect(close_old_connections)
+                    try:
+                        response.close()
+                    finally:
+                        request_finished.connect(close_old_connections)
+                elif response.streaming:
+                    b''.join(response.streaming_content)
+            self.stdout.write(self.style.MIGRATE_HEADING('%s -> %d' % (label, response.status_code)))
+            for query in captured.captured_queries:
+                self.explain(label, query['sql'], full_read)
+        # The purges the deletes above enqueued, as blog_worker runs them.
+        with CaptureQueriesContext(connection) as captured:
+            tasks.run_due()
+        self.stdout.write(self.style.MIGRATE_HEADING('blog_worker'))
+        for query in captured.captured_queries:
+            self.explain('blog_worker', query['sql'], False)
+
+    def explain(self, label, sql, full_read):
+        if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            return
+        if 'django_session' in sql or 'auth_user' in sql:
+            return
+        self.stdout.write('  ' + sql)
+        with connection.cursor() as cursor:
+            cursor.execute('%s %s' % (connection.ops.explain_prefix, sql))
+            plan = [' '.join(str(column) for column in row[-1:]) for row in cursor.fetchall()]
+        for line in plan:
+            self.stdout.write('    ' + line)
+            if not full_read and self.is_full_scan(sql, line):
+                self.scans.append((label, line))
+
+    def is_full_scan(self, sql, line):
+        if connection.vendor != 'sqlite':
+            return 'Seq Scan' in line
+        words = line.split()
+        # SCAN reads every row, through an index or not ("USING COVERING
+        # INDEX" reads the whole index); SEARCH is a lookup.
+        if words[:1] != ['SCAN'] or words[1] not in self.tables:
+            return False
+        if 'VIRTUAL' in words:
+            # FTS5 plans read "VIRTUAL TABLE INDEX 0:M..." when a MATCH drives the lookup.
+            return ':M' not in words[-1]
+        # Keyset pages walk the table in primary key order and stop at LIMIT.
+        return not re.search(r'ORDER BY "\w+"\."id" (ASC|DESC)\s+LIMIT', sql)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from blog.transfer import FORMATS, TransferError, export
+
+
+class Command(BaseCommand):
+    help = ('Writes every user and every live article and comment to a directory of '
+            'NDJSON or CSV files, read through chunked cursors, for blog_import.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes, each writing one id range of every model to its own file.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per cursor read.')
+        parser.add_argument('--progress', type=float, default=5, help='Seconds between progress reports.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--workers and --chunk-size must be positive')
+        try:
+            manifest = export(options['directory'], options['format'], options['workers'], options['chunk_size'],
+                              self.stdout.write, options['progress'])
+        except (OSError, TransferError) as e:
+            raise CommandError(e)
+        for kind, entry in manifest['models'].items():
+            self.stdout.write('%s: %d rows in %d file(s)' % (kind, entry['rows'], len(entry['parts'])))
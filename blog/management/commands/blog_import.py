@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from blog.routers import primary
+from blog.transfer import TransferError, load
+
+
+class Command(BaseCommand):
+    help = ('Loads a blog_export directory: users are matched by username, and '
+            'articles and comments are inserted with ids past the ones in use, '
+            'a batch per transaction.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes loading the article and comment files in parallel.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows inserted per transaction.')
+        parser.add_argument('--progress', type=float, default=5, help='Seconds between progress reports.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--workers and --batch-size must be positive')
+        try:
+            # Reads check rows this import has just written.
+            with primary():
+                totals = load(options['directory'], options['workers'], options['batch_size'],
+                              self.stdout.write, options['progress'])
+        except (OSError, TransferError) as e:
+            raise CommandError(e)
+        for kind, (imported, skipped) in totals.items():
+            self.stdout.write('%s: %d rows imported, %d skipped' % (kind, imported, skipped))
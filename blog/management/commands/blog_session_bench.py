@@ -0,0 +1,75 @@
+import json
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from blog.models import Article, Comment
+from blog.routers import primary
+
+MODES = ('db', 'cached_db', 'cache', 'signed_cookies')
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Signs in through the blog API under each session storage mode and '
+            'reports session queries per request and read throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', action='append', choices=MODES, dest='modes',
+                            help='Mode to run; repeatable. Defaults to every mode.')
+        parser.add_argument('--requests', type=int, default=300,
+                            help='Authenticated API reads per mode.')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be positive')
+        self.stdout.write('current mode: %s' % getattr(settings, 'BLOG_SESSION_MODE', 'db'))
+        self.stdout.write('%-15s %14s %14s %14s %10s' % ('mode', 'signin q/req', 'read q/req', 'signout q/req', 'reads/s'))
+        for mode in options['modes'] or MODES:
+            try:
+                # The rows are never committed, so replicas cannot see them.
+                with transaction.atomic(), primary(), override_settings(
+                        ALLOWED_HOSTS=['*'], SESSION_ENGINE='django.contrib.sessions.backends.' + mode):
+                    row = self.bench(options['requests'])
+                    raise Rollback
+            except Rollback:
+                pass
+            self.stdout.write('%-15s %14.2f %14.2f %14.2f %10.1f' % ((mode,) + row))
+
+    def bench(self, count):
+        user = User.objects.create_user(username='blog_session_bench', password='blog_session_bench')
+        article = Article.objects.create(title='bench', content='bench', author=user)
+        comment = Comment.objects.create(article=article, content='bench', author=user)
+        urls = ['/api/article/', '/api/article/%d/' % article.id,
+                '/api/article/%d/comment/' % article.id, '/api/comment/%d/' % comment.id]
+        # A fresh client loads SessionMiddleware under the overridden engine.
+        client = Client()
+        signin_queries, response = self.session_queries(lambda: client.post(
+            '/api/signin/', json.dumps({'username': user.username, 'password': 'blog_session_bench'}),
+            content_type='application/json'))
+        if response.status_code != 204:
+            raise CommandError('signin returned %d' % response.status_code)
+        # Warm the detail caches so the timing is dominated by request handling.
+        for url in urls:
+            client.get(url)
+        read_queries = 0
+        start = time.perf_counter()
+        for index in range(count):
+            queries, response = self.session_queries(lambda: client.get(urls[index % len(urls)]))
+            if response.status_code != 200:
+                raise CommandError('%s returned %d' % (urls[index % len(urls)], response.status_code))
+            read_queries += queries
+        elapsed = time.perf_counter() - start
+        signout_queries, response = self.session_queries(lambda: client.get('/api/signout/'))
+        return signin_queries, read_queries / count, signout_queries, count / elapsed
+
+    def session_queries(self, send):
+        with CaptureQueriesContext(connection) as captured:
+            response = send()
+        return sum('django_session' in query['sql'] for query in captured.captured_queries), response
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+from blog.management.commands.blog_bench import HTTPClient
+
+MARKER = b'event: create'
+
+
+class Command(BaseCommand):
+    help = ("Holds many idle comment event streams open against a running server "
+            "(preferably myblog.asgi under an ASGI server), then posts comments and "
+            "reports how long each took to reach every subscriber.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True, help='Base URL of a running server, e.g. http://127.0.0.1:8000/api')
+        parser.add_argument('--subscribers', type=int, default=2000)
+        parser.add_argument('--connect-concurrency', type=int, default=100,
+                            help='Streams being opened at once.')
+        parser.add_argument('--rounds', type=int, default=5, help='Comments posted, one after another.')
+        parser.add_argument('--idle', type=float, default=5, help='Seconds to hold the streams idle before posting.')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a comment to reach everyone.')
+        parser.add_argument('--pid', type=int, help="The server's process id, to report its memory.")
+
+    def handle(self, *args, **options):
+        for name in ('subscribers', 'connect_concurrency', 'rounds'):
+            if options[name] < 1:
+                raise CommandError('--%s must be positive' % name.replace('_', '-'))
+        self.options = options
+        url = urlsplit(options['url'])
+        self.host, self.port, self.prefix = url.hostname, url.port or 80, url.path.rstrip('/')
+        self.client = HTTPClient(options['url'], SimpleCookie())
+        self.article = self.prepare()
+        asyncio.run(self.bench())
+
+    def call(self, method, path, data=None, expected=200):
+        status, timing, body = self.client.request(method, path, data)
+        if status != expected:
+            raise CommandError('%s %s returned %d' % (method, path, status))
+        return body
+
+    def prepare(self):
+        """Signs up a user of its own and creates the article to stream."""
+        credentials = {'username': 'stream-bench-%x' % int(time.time() * 1000), 'password': 'blog_stream_bench'}
+        self.call('GET', '/token/', expected=204)
+        self.call('POST', '/signup/', credentials, expected=201)
+        self.call('POST', '/signin/', credentials, expected=204)
+        body = self.call('POST', '/article/', {'title': 'stream bench', 'content': 'stream bench'}, expected=201)
+        return json.loads(body.decode())['id']
+
+    async def bench(self):
+        options = self.options
+        count = options['subscribers']
+        self.received = [[] for _ in range(options['rounds'])]
+        self.changed = asyncio.Event()
+        gate = asyncio.Semaphore(options['connect_concurrency'])
+        opened = asyncio.get_event_loop().create_future()
+        self.open = 0
+
+        async def subscriber():
+            async with gate:
+                reader, writer = await self.subscribe()
+            self.open += 1
+            if self.open == count:
+                opened.set_result(None)
+            await self.listen(reader)
+            writer.close()
+
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(subscriber()) for _ in range(count)]
+        done, pending = await asyncio.wait(tasks + [opened], return_when=asyncio.FIRST_COMPLETED)
+        if not opened.done():
+            for task in tasks:
+                task.cancel()
+            raise CommandError('%d of %d streams opened: %r' % (
+                self.open, count, next(task.exception() for task in done if task is not opened)))
+        self.stdout.write('%d streams open in %.2f s' % (count, time.perf_counter() - start))
+        self.report_memory()
+        await asyncio.sleep(options['idle'])
+        self.report_memory()
+        self.stdout.write('%5s %10s %10s %10s %10s %10s %10s' % (
+            'round', 'reached', 'post ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        loop = asyncio.get_event_loop()
+        for number in range(options['rounds']):
+            posted = time.perf_counter()
+            await loop.run_in_executor(None, self.call, 'POST', '/article/%d/comment/' % self.article,
+                                       {'content': 'stream bench %d' % number}, 201)
+            post_ms = (time.perf_counter() - posted) * 1000
+            deadline = posted + options['timeout']
+            while len(self.received[number]) < count and time.perf_counter() < deadline:
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), deadline - time.perf_counter())
+                except asyncio.TimeoutError:
+                    break
+            latencies = sorted((received - posted) * 1000 for received in self.received[number])
+            self.stdout.write('%5d %10d %10.2f %10s %10s %10s %10s' % (
+                number, len(latencies), post_ms, *(
+                    '%.2f' % latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else '-'
+                    for q in (0.5, 0.95, 0.99, 1))))
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+    async def subscribe(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        cookies = '; '.join('%s=%s' % (name, morsel.value) for name, morsel in self.client.cookies.items())
+        writer.write(('GET %s/article/%d/comment/stream/ HTTP/1.1\r\nHost: %s:%d\r\nCookie: %s\r\n'
+                      'Accept: text/event-stream\r\n\r\n' % (
+                          self.prefix, self.article, self.host, self.port, cookies)).encode('latin1'))
+        headers = await reader.readuntil(b'\r\n\r\n')
+        if not headers.startswith((b'HTTP/1.1 200', b'HTTP/1.0 200')):
+            raise CommandError('stream answered %r' % headers.split(b'\r\n', 1)[0])
+        return reader, writer
+
+    async def listen(self, reader):
+        seen = 0
+        tail = b''
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                return
+            data = tail + chunk
+            # Kept so a marker split between reads is found once.
+            tail = data[-len(MARKER) + 1:]
+            now = time.perf_counter()
+            for _ in range(data.count(MARKER)):
+                if seen < len(self.received):
+                    self.received[seen].append(now)
+                    seen += 1
+            self.changed.set()
+
+    def report_memory(self):
+        if self.options['pid'] is None:
+            return
+        try:
+            with open('/proc/%d/status' % self.options['pid']) as status:
+                rss = next(line.split()[1] for line in status if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            return
+        self.stdout.write('server RSS %.1f MiB' % (int(rss) / 1024))
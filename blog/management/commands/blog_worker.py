@@ -0,0 +1,48 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from blog import tasks
+from blog.routers import primary
+
+
+class Command(BaseCommand):
+    help = ('Runs the background tasks the blog API enqueues, such as purging '
+            'soft-deleted articles and comments. Start as many as needed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the tasks due now, then exit.')
+        parser.add_argument('--status', action='store_true', help='Report the queue and the failed tasks, then exit.')
+        parser.add_argument('--retry-failed', action='store_true', help='Make the failed tasks due again, then exit.')
+
+    def handle(self, *args, **options):
+        # Claims must see every other worker's claims at once.
+        with primary():
+            if options['status']:
+                return self.status()
+            if options['retry_failed']:
+                self.stdout.write('%d failed task(s) due again' % tasks.retry_failed())
+                return
+            while True:
+                succeeded, failed = tasks.run_due()
+                if succeeded or failed:
+                    self.stdout.write('%d task(s) done, %d failed' % (succeeded, failed))
+                if options['once']:
+                    return
+                # As between requests: drop a connection that errored or aged out.
+                close_old_connections()
+                if not succeeded + failed:
+                    time.sleep(getattr(settings, 'BLOG_TASK_POLL_INTERVAL', 1))
+
+    def status(self):
+        now = timezone.now()
+        counts = tasks.status()
+        for state in ('pending', 'running', 'failed'):
+            count, oldest = counts.get(state, (0, None))
+            age = '' if oldest is None or state != 'pending' else ', oldest due %.0f s ago' % max(
+                0, (now - oldest).total_seconds())
+            self.stdout.write('%s: %d%s' % (state, count, age))
+        for task in tasks.failed():
+            self.stdout.write('task %d %s %s after %d attempt(s):\n%s' % (
+                task.pk, task.name, task.payload, task.attempts, task.last_error))
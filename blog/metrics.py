@@ -0,0 +1,161 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from .cache import article_cache, comment_cache
+from .changes import comment_hub
+from . import tasks
+from .hashing import hashing_pool
+
+# In-process request metrics. A RequestMetrics collects one request's
+# database time and query counts through a connection execute_wrapper, and
+# named timings through timer(). The registry folds finished requests into
+# fixed-bucket histograms per URL name, so recording is a few additions and
+# a bisect, and renders them in the Prometheus text format.
+
+SECONDS = tuple(0.0005 * 2 ** (step / 2) for step in range(30))  # 0.5ms .. ~10.5s
+COUNTS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100, 200, 500)
+BYTES = tuple(256 * 2 ** step for step in range(17))  # 256B .. 16MiB
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current = threading.local()
+
+class RequestMetrics:
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.duplicates = 0
+        self.statements = set()
+        self.timers = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries += 1
+            # The same statement issued twice in one request is a repeated
+            # lookup or an N+1 loop, whatever its parameters.
+            if sql in self.statements:
+                self.duplicates += 1
+            else:
+                self.statements.add(sql)
+
+    def server_timing(self, seconds):
+        entries = ['app;dur=%.1f' % (seconds * 1000),
+                   'db;dur=%.1f;desc="%d queries / %d duplicate"' % (self.db_seconds * 1000, self.queries, self.duplicates)]
+        entries += ['%s;dur=%.1f' % (name, elapsed * 1000) for name, elapsed in sorted(self.timers.items())]
+        return ', '.join(entries)
+
+def begin(record):
+    _current.record = record
+
+def end():
+    _current.record = None
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the block to the current request's name timing."""
+    record = getattr(_current, 'record', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.timers[name] = record.timers.get(name, 0.0) + time.perf_counter() - start
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile; the maximum past the last bucket."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+SERIES = (
+    ('request_seconds', SECONDS, 'Wall time per request.'),
+    ('db_seconds', SECONDS, 'Database time per request.'),
+    ('queries', COUNTS, 'Queries per request.'),
+    ('serialize_seconds', SECONDS, 'Response serialization time per request.'),
+    ('response_bytes', BYTES, 'Response body size; streamed bodies are not counted.'),
+)
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.duplicates = {}
+
+    def observe(self, view, seconds, record, size):
+        with self.lock:
+            if view not in self.views:
+                self.views[view] = {name: Histogram(bounds) for name, bounds, _ in SERIES}
+                self.duplicates[view] = 0
+            histograms = self.views[view]
+            histograms['request_seconds'].observe(seconds)
+            histograms['db_seconds'].observe(record.db_seconds)
+            histograms['queries'].observe(record.queries)
+            histograms['serialize_seconds'].observe(record.timers.get('serialize', 0.0))
+            if size is not None:
+                histograms['response_bytes'].observe(size)
+            self.duplicates[view] += record.duplicates
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, bounds, description in SERIES:
+                lines += ['# HELP blog_%s %s' % (name, description), '# TYPE blog_%s summary' % name]
+                for view, histograms in sorted(self.views.items()):
+                    histogram = histograms[name]
+                    for q in QUANTILES:
+                        lines.append('blog_%s{view="%s",quantile="%s"} %s' % (name, view, q, _number(histogram.quantile(q))))
+                    lines.append('blog_%s_sum{view="%s"} %s' % (name, view, _number(histogram.sum)))
+                    lines.append('blog_%s_count{view="%s"} %d' % (name, view, histogram.count))
+            lines += ['# HELP blog_duplicate_queries_total Queries repeating an earlier statement of the same request.',
+                      '# TYPE blog_duplicate_queries_total counter']
+            lines += ['blog_duplicate_queries_total{view="%s"} %d' % item for item in sorted(self.duplicates.items())]
+        for key in ('hits', 'local_hits', 'misses', 'evictions'):
+            lines.append('# TYPE blog_cache_%s_total counter' % key)
+            for object_cache in (article_cache, comment_cache):
+                lines.append('blog_cache_%s_total{cache="%s"} %d' % (key, object_cache.prefix, object_cache.stats[key]))
+        stats = hashing_pool.stats
+        lines += ['# TYPE blog_hashes_total counter', 'blog_hashes_total %d' % stats['hashes'],
+                  '# TYPE blog_hash_seconds_total counter', 'blog_hash_seconds_total %s' % _number(stats['hash_seconds']),
+                  '# TYPE blog_hash_rejected_total counter', 'blog_hash_rejected_total %d' % stats['rejected'],
+                  '# TYPE blog_hash_queue_depth gauge', 'blog_hash_queue_depth %d' % stats['queue_depth'],
+                  '# TYPE blog_hash_max_queue_depth gauge', 'blog_hash_max_queue_depth %d' % stats['max_queue_depth']]
+        lines.append('# TYPE blog_tasks gauge')
+        counts = tasks.status()
+        lines += ['blog_tasks{state="%s"} %d' % (state, counts.get(state, (0,))[0]) for state in ('pending', 'running', 'failed')]
+        stats = comment_hub.stats
+        lines += ['# TYPE blog_event_subscribers gauge', 'blog_event_subscribers{hub="comments"} %d' % stats['subscribers'],
+                  '# TYPE blog_event_rejected_total counter', 'blog_event_rejected_total{hub="comments"} %d' % stats['rejected'],
+                  '# TYPE blog_event_notified_total counter', 'blog_event_notified_total{hub="comments"} %d' % stats['notified']]
+        return '\n'.join(lines) + '\n'
+
+def _number(value):
+    return '%.6g' % value
+
+registry = Registry()
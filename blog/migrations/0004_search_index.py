@@ -0,0 +1,50 @@
+from django.db import migrations
+
+# Full-text index for /api/search/. SQLite only: FTS5 tables shadow
+# blog_article and blog_comment as external-content indexes. The triggers
+# that keep them in sync are installed by blog.search after every migrate,
+# since SQLite table rebuilds in later migrations drop triggers. Other
+# backends get nothing here and search with icontains.
+
+FORWARD = [
+    "CREATE VIRTUAL TABLE blog_article_fts USING fts5("
+    "title, content, content='blog_article', content_rowid='id')",
+    "INSERT INTO blog_article_fts(blog_article_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE blog_comment_fts USING fts5("
+    "content, content='blog_comment', content_rowid='id')",
+    "INSERT INTO blog_comment_fts(blog_comment_fts) VALUES ('rebuild')",
+]
+
+BACKWARD = [
+    "DROP TABLE IF EXISTS blog_article_fts",
+    "DROP TABLE IF EXISTS blog_comment_fts",
+]
+
+
+def has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return 'ENABLE_FTS5' in {row[0] for row in cursor.fetchall()}
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite' and has_fts5(schema_editor.connection):
+        for statement in FORWARD:
+            schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in BACKWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0003_access_pattern_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
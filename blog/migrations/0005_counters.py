@@ -0,0 +1,63 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Fills the counter tables from the rows already present; afterwards the
+# API keeps them current and blog_rebuild_counters repairs any drift.
+
+FILL = [
+    "INSERT INTO blog_authorstats (user_id, articles, comments) "
+    "SELECT id, (SELECT COUNT(*) FROM blog_article WHERE author_id = auth_user.id), "
+    "(SELECT COUNT(*) FROM blog_comment WHERE author_id = auth_user.id) FROM auth_user "
+    "WHERE id IN (SELECT author_id FROM blog_article UNION SELECT author_id FROM blog_comment)",
+    "INSERT INTO blog_articlestats (article_id, comments) "
+    "SELECT article_id, COUNT(*) FROM blog_comment GROUP BY article_id",
+    "INSERT INTO blog_commenterstats (article_id, author_id, comments) "
+    "SELECT article_id, author_id, COUNT(*) FROM blog_comment GROUP BY article_id, author_id",
+]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0011_update_proxy_permissions'),
+        ('blog', '0004_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleStats',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='blog.Article')),
+                ('comments', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AuthorStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='blog_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('articles', models.IntegerField(default=0)),
+                ('comments', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommenterStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('comments', models.IntegerField(default=0)),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commenter_stats', to='blog.Article')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commenter_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='commenterstats',
+            index=models.Index(fields=['article', '-comments', 'author'], name='blog_commenter_top_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='commenterstats',
+            unique_together={('article', 'author')},
+        ),
+        migrations.RunSQL(FILL, migrations.RunSQL.noop),
+    ]
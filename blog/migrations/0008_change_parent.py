@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='parent_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['parent_id', 'seq'], name='blog_change_parent_seq_idx'),
+        ),
+        # Tombstones of comments already gone keep no article.
+        migrations.RunSQL(
+            "UPDATE blog_change SET parent_id = (SELECT article_id FROM blog_comment "
+            "WHERE blog_comment.id = blog_change.object_id) WHERE kind = 'comment'",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:11
+
+import blog.content
+from django.db import migrations
+
+# Bodies may now be stored compressed (see blog.content). Existing rows are
+# packed for BLOG_COMPRESS_CONTENT_OVER as it stands when this runs, and
+# get their summaries; `manage.py blog_compress` repacks after the setting
+# changes. On SQLite the full-text indexes of migration 0004 read their
+# text from the tables, which may now hold compressed bytes, so they are
+# rebuilt as indexes keeping their own copy of the plain text, filled once
+# here through blog_inflate(); blog.search reinstalls the triggers, plain
+# SQL, after migrate.
+
+TRIGGERS = [
+    'blog_article_fts_insert', 'blog_article_fts_delete', 'blog_article_fts_update', 'blog_article_fts_retitle',
+    'blog_comment_fts_insert', 'blog_comment_fts_delete', 'blog_comment_fts_update',
+]
+
+FORWARD = [
+    "DROP TABLE blog_article_fts",
+    "DROP TABLE blog_comment_fts",
+    "CREATE VIRTUAL TABLE blog_article_fts USING fts5(title, content)",
+    "INSERT INTO blog_article_fts(rowid, title, content) SELECT id, title, blog_inflate(content) FROM blog_article",
+    "CREATE VIRTUAL TABLE blog_comment_fts USING fts5(content)",
+    "INSERT INTO blog_comment_fts(rowid, content) SELECT id, blog_inflate(content) FROM blog_comment",
+]
+
+BACKWARD = [
+    "CREATE VIRTUAL TABLE blog_article_fts USING fts5("
+    "title, content, content='blog_article', content_rowid='id')",
+    "INSERT INTO blog_article_fts(blog_article_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE blog_comment_fts USING fts5("
+    "content, content='blog_comment', content_rowid='id')",
+    "INSERT INTO blog_comment_fts(blog_comment_fts) VALUES ('rebuild')",
+]
+
+
+def has_index(connection):
+    return connection.vendor == 'sqlite' and 'blog_article_fts' in connection.introspection.table_names()
+
+
+def drop_triggers(schema_editor):
+    for name in TRIGGERS:
+        schema_editor.execute('DROP TRIGGER IF EXISTS %s' % name)
+
+
+def pack_rows(apps, schema_editor):
+    connection = schema_editor.connection
+    indexed = has_index(connection)
+    if indexed:
+        drop_triggers(schema_editor)
+    for table in ('blog_article', 'blog_comment'):
+        blog.content.repack(connection, table)
+    if indexed:
+        for statement in FORWARD:
+            schema_editor.execute(statement)
+
+
+def inflate_rows(apps, schema_editor):
+    connection = schema_editor.connection
+    indexed = has_index(connection)
+    if indexed:
+        drop_triggers(schema_editor)
+        schema_editor.execute("DROP TABLE blog_article_fts")
+        schema_editor.execute("DROP TABLE blog_comment_fts")
+    for table in ('blog_article', 'blog_comment'):
+        blog.content.repack(connection, table, inflate=True)
+    # Rebuilt from the inflated rows.
+    if indexed:
+        for statement in BACKWARD:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_soft_delete_tasks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='summary',
+            field=blog.content.SummaryField(default='', editable=False, source='content'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='summary',
+            field=blog.content.SummaryField(default='', editable=False, source='content'),
+        ),
+        migrations.AlterField(
+            model_name='article',
+            name='content',
+            field=blog.content.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='content',
+            field=blog.content.CompressedTextField(),
+        ),
+        migrations.RunPython(pack_rows, inflate_rows),
+    ]
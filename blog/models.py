@@ -1,15 +1,41 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
+from .content import CompressedTextField, SummaryField
+
+class LiveManager(models.Manager):
+    """Hides soft-deleted rows; blog.tasks purges them in the background."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
 
 class Article(models.Model):
     title = models.CharField(max_length=64)
-    content = models.TextField()
+    content = CompressedTextField()
+    summary = SummaryField(default='')
     author = models.ForeignKey(
             User,
             on_delete=models.CASCADE,
             related_name='article_set',
     )
-    
+    updated_at = models.DateTimeField(auto_now=True)
+    # Bumped by every update; detail ETags carry it for If-Match.
+    version = models.PositiveIntegerField(default=1, editable=False)
+    deleted_at = models.DateTimeField(null=True, editable=False)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', 'id'], name='blog_article_author_id_idx'),
+            models.Index(fields=['title'], name='blog_article_title_idx'),
+            # The list validators' MAX(updated_at) over live rows is one seek
+            # into this index.
+            models.Index(fields=['updated_at', 'deleted_at'], name='blog_article_live_idx',
+                         condition=Q(deleted_at__isnull=True)),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -19,12 +45,103 @@ class Comment(models.Model):
             on_delete=models.CASCADE,
             related_name='comment_set',
     )
-    content = models.TextField()
+    content = CompressedTextField()
+    summary = SummaryField(default='')
     author = models.ForeignKey(
             User,
             on_delete=models.CASCADE,
             related_name='comment_set',
     )
+    updated_at = models.DateTimeField(auto_now=True)
+    version = models.PositiveIntegerField(default=1, editable=False)
+    deleted_at = models.DateTimeField(null=True, editable=False)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['article', 'id'], name='blog_comment_article_id_idx'),
+            models.Index(fields=['updated_at', 'deleted_at'], name='blog_comment_live_idx',
+                         condition=Q(deleted_at__isnull=True)),
+        ]
 
     def __str__(self):
         return self.content
+
+# Denormalized counters, maintained by blog.counters alongside every write
+# the API makes, so the stats endpoints read one row or one index range.
+
+class AuthorStats(models.Model):
+    user = models.OneToOneField(
+            User,
+            on_delete=models.CASCADE,
+            primary_key=True,
+            related_name='blog_stats',
+    )
+    articles = models.IntegerField(default=0)
+    comments = models.IntegerField(default=0)
+
+class ArticleStats(models.Model):
+    article = models.OneToOneField(
+            Article,
+            on_delete=models.CASCADE,
+            primary_key=True,
+            related_name='stats',
+    )
+    comments = models.IntegerField(default=0)
+
+class CommenterStats(models.Model):
+    article = models.ForeignKey(
+            Article,
+            on_delete=models.CASCADE,
+            related_name='commenter_stats',
+    )
+    author = models.ForeignKey(
+            User,
+            on_delete=models.CASCADE,
+            related_name='commenter_stats',
+    )
+    comments = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('article', 'author')]
+        indexes = [
+            models.Index(fields=['article', '-comments', 'author'], name='blog_commenter_top_idx'),
+        ]
+
+class Change(models.Model):
+    """One entry of the change feed; seq orders the feed."""
+    ACTIONS = [('create', 'create'), ('update', 'update'), ('delete', 'delete')]
+    KINDS = [('article', 'article'), ('comment', 'comment')]
+
+    seq = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=8, choices=KINDS)
+    object_id = models.IntegerField()
+    # The article of a comment, so one article's comment changes are one index range.
+    parent_id = models.IntegerField(null=True)
+    action = models.CharField(max_length=8, choices=ACTIONS)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['parent_id', 'seq'], name='blog_change_parent_seq_idx'),
+        ]
+
+class Task(models.Model):
+    """A background job run by blog_worker; see blog.tasks."""
+    STATES = [('pending', 'pending'), ('running', 'running'), ('failed', 'failed')]
+
+    name = models.CharField(max_length=32)
+    payload = models.TextField()
+    state = models.CharField(max_length=8, choices=STATES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # When a pending task is due, or when a running one's lease expires.
+    run_after = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'run_after'], name='blog_task_due_idx'),
+        ]
@@ -0,0 +1,78 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from django.conf import settings
+
+# Keyset pagination on the primary key: each page is a single indexed range
+# scan, so deep pages cost the same as the first one.
+
+# The range of the integer columns ids and sequence numbers are compared
+# with; a larger Python int overflows the database driver.
+MAX_INT = 2 ** 63 - 1
+
+def bounded(value):
+    """Returns the int value, or raises ValueError if a database column could not hold it."""
+    if not -MAX_INT - 1 <= value <= MAX_INT:
+        raise ValueError('integer out of range')
+    return value
+
+def encode_cursor(pk):
+    return urlsafe_b64encode(str(pk).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return bounded(int(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()))
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        raise ValueError('invalid cursor')
+
+def get_limit(request):
+    max_size = getattr(settings, 'BLOG_MAX_PAGE_SIZE', 100)
+    limit = request.GET.get('limit')
+    if limit is None:
+        return min(getattr(settings, 'BLOG_PAGE_SIZE', 20), max_size)
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, max_size)
+
+def paginate(request, queryset, key=lambda row: row.pk):
+    """
+    Returns (rows, next_cursor, prev_cursor) for the page selected by the
+    limit/after/before query parameters. Raises ValueError on bad parameters.
+    key extracts the primary key from a row.
+    """
+    limit = get_limit(request)
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if after is not None and before is not None:
+        raise ValueError('after and before are mutually exclusive')
+
+    if before is not None:
+        rows = list(queryset.filter(pk__lt=decode_cursor(before)).order_by('-pk')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        next_cursor = encode_cursor(key(rows[-1])) if rows else None
+        prev_cursor = encode_cursor(key(rows[0])) if has_more else None
+    else:
+        if after is not None:
+            queryset = queryset.filter(pk__gt=decode_cursor(after))
+        rows = list(queryset.order_by('pk')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key(rows[-1])) if has_more else None
+        prev_cursor = encode_cursor(key(rows[0])) if after is not None and rows else None
+    return rows, next_cursor, prev_cursor
+
+def set_page_links(request, response, next_cursor, prev_cursor):
+    links = []
+    for rel, param, cursor in (('next', 'after', next_cursor), ('prev', 'before', prev_cursor)):
+        if cursor is None:
+            continue
+        params = request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[param] = cursor
+        links.append('<%s?%s>; rel="%s"' % (request.path, params.urlencode(), rel))
+        response['X-%s-Cursor' % rel.capitalize()] = cursor
+    if links:
+        response['Link'] = ', '.join(links)
+    return response
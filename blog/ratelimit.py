@@ -0,0 +1,126 @@
+import ipaddress
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import caches
+
+# Admission control for the write and auth views. Each unsafe request to a
+# view named in BLOG_RATE_LIMITS takes a token from its client IP's bucket
+# and, when signed in, from its user's bucket; a bucket holds `capacity`
+# tokens and refills them over `seconds`. Buckets live in this process, or
+# in the BLOG_RATE_LIMIT_CACHE cache to be shared between processes (its
+# read-modify-write can admit a few extra requests under races). Separately,
+# at most BLOG_WRITE_CONCURRENCY write views run at once per process.
+# Behind a reverse proxy, every request comes from the proxy's address; a
+# request from one of the BLOG_TRUSTED_PROXIES is keyed by the address its
+# X-Forwarded-For names instead, read from the right past any trusted hops,
+# since a client can put anything on the left.
+
+class LocalBuckets:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = OrderedDict()
+
+    def take(self, key, capacity, seconds):
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, None))
+            tokens, wait = _take(tokens, updated, capacity, seconds)
+            self.buckets[key] = (tokens, time.monotonic())
+            while len(self.buckets) > getattr(settings, 'BLOG_RATE_LIMIT_KEYS', 10000):
+                self.buckets.popitem(last=False)
+        return wait
+
+class CacheBuckets:
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def take(self, key, capacity, seconds):
+        key = 'blog:ratelimit:%s' % key
+        tokens, updated = self.cache.get(key, (capacity, None))
+        tokens, wait = _take(tokens, updated, capacity, seconds, now=time.time())
+        self.cache.set(key, (tokens, time.time()), seconds)
+        return wait
+
+def _take(tokens, updated, capacity, seconds, now=None):
+    """Returns (tokens left, seconds to wait), taking one token unless the wait is positive."""
+    if updated is not None:
+        now = time.monotonic() if now is None else now
+        tokens = min(capacity, tokens + (now - updated) * capacity / seconds)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * seconds / capacity
+
+local_buckets = LocalBuckets()
+
+def buckets():
+    alias = getattr(settings, 'BLOG_RATE_LIMIT_CACHE', None)
+    return CacheBuckets(alias) if alias else local_buckets
+
+@lru_cache(maxsize=8)
+def _networks(proxies):
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+def _trusted(address, networks):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+def client_ip(request):
+    address = request.META.get('REMOTE_ADDR', '')
+    networks = _networks(tuple(getattr(settings, 'BLOG_TRUSTED_PROXIES', ())))
+    if not _trusted(address, networks):
+        return address
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        hop = hop.strip()
+        if not hop:
+            break
+        address = hop
+        if not _trusted(address, networks):
+            break
+    return address
+
+def check_rate(request, view):
+    """Returns the whole seconds to wait before retrying, or 0 if the request may proceed."""
+    limit = getattr(settings, 'BLOG_RATE_LIMITS', {}).get(view)
+    if limit is None:
+        return 0
+    capacity, seconds = limit
+    keys = ['%s:ip:%s' % (view, client_ip(request))]
+    if request.user.is_authenticated:
+        keys.append('%s:user:%s' % (view, request.user.pk))
+    store = buckets()
+    # Each bucket with a token left is charged even when another refuses,
+    # so a client cannot spread its requests over addresses or accounts.
+    wait = max(store.take(key, capacity, seconds) for key in keys)
+    return math.ceil(wait)
+
+class WriteGate:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = 0
+
+    def enter(self):
+        """Returns False if no write slot frees up within BLOG_WRITE_WAIT seconds."""
+        limit = getattr(settings, 'BLOG_WRITE_CONCURRENCY', None)
+        with self.condition:
+            if limit is not None and not self.condition.wait_for(
+                    lambda: self.running < limit, getattr(settings, 'BLOG_WRITE_WAIT', 0.1)):
+                return False
+            self.running += 1
+        return True
+
+    def leave(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+write_gate = WriteGate()
@@ -0,0 +1,50 @@
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+# Read replicas. Reads of blog rows go to a random alias in BLOG_DB_REPLICAS
+# unless the current request is pinned to the primary: unsafe requests are,
+# and so are requests carrying the cookie those leave behind for
+# BLOG_REPLICA_PIN_SECONDS, so clients always read their own writes.
+
+PIN_COOKIE = 'blog_primary_until'
+
+_state = threading.local()
+
+def is_pinned():
+    return getattr(_state, 'request', False) or getattr(_state, 'block', False)
+
+def pin(pinned):
+    """Pins or releases the current request."""
+    _state.request = pinned
+
+def unpin(**kwargs):
+    """request_finished receiver; runs after streamed bodies are read."""
+    _state.request = False
+
+@contextmanager
+def primary():
+    """Sends every read in the block to the primary, whatever the requests in it do."""
+    block = getattr(_state, 'block', False)
+    _state.block = True
+    try:
+        yield
+    finally:
+        _state.block = block
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'BLOG_DB_REPLICAS', [])
+        if model._meta.app_label != 'blog' or not replicas or is_pinned():
+            return 'default'
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return True
@@ -0,0 +1,232 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from functools import reduce
+from operator import and_
+from django.db import connections, router
+from django.db.models import Q
+from django.utils.html import escape
+from .content import compressible
+from .models import Article, Comment
+from .pagination import bounded
+
+# Ranked search over article titles and contents and comment contents. On
+# SQLite with FTS5 this reads the blog_article_fts and blog_comment_fts
+# indexes (migrations 0004 and 0010); elsewhere it falls back to icontains
+# scans. Results are ordered by (rank, type, id), which is also the cursor.
+# Soft-deleted rows stay indexed until purged, and are filtered out here.
+# The indexes keep their own copy of the plain text. The triggers index
+# bodies stored as text, titles, and deletes in plain SQL, so the sqlite3
+# shell and backup tools can write the tables too; bodies stored compressed
+# (blog.content) are indexed by the writer through index(), and a body
+# compressed by hand outside Django stays indexed as it was. The icontains
+# fallback cannot search inside compressed bodies.
+
+TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_insert AFTER INSERT ON blog_article "
+    "WHEN typeof(new.content) = 'text' BEGIN "
+    "INSERT INTO blog_article_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_delete AFTER DELETE ON blog_article BEGIN "
+    "DELETE FROM blog_article_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_update AFTER UPDATE OF title, content ON blog_article "
+    "WHEN typeof(new.content) = 'text' BEGIN "
+    "DELETE FROM blog_article_fts WHERE rowid = old.id; "
+    "INSERT INTO blog_article_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_retitle AFTER UPDATE OF title ON blog_article "
+    "WHEN typeof(new.content) != 'text' BEGIN "
+    "UPDATE blog_article_fts SET title = new.title WHERE rowid = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_insert AFTER INSERT ON blog_comment "
+    "WHEN typeof(new.content) = 'text' BEGIN "
+    "INSERT INTO blog_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_delete AFTER DELETE ON blog_comment BEGIN "
+    "DELETE FROM blog_comment_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_update AFTER UPDATE OF content ON blog_comment "
+    "WHEN typeof(new.content) = 'text' BEGIN "
+    "DELETE FROM blog_comment_fts WHERE rowid = old.id; "
+    "INSERT INTO blog_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+# For the external-content indexes of migration 0004, which read the
+# tables' text; installed only while the schema is rolled back past 0010.
+EXTERNAL_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_insert AFTER INSERT ON blog_article BEGIN "
+    "INSERT INTO blog_article_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_delete AFTER DELETE ON blog_article BEGIN "
+    "INSERT INTO blog_article_fts(blog_article_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_article_fts_update AFTER UPDATE OF title, content ON blog_article BEGIN "
+    "INSERT INTO blog_article_fts(blog_article_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); "
+    "INSERT INTO blog_article_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_insert AFTER INSERT ON blog_comment BEGIN "
+    "INSERT INTO blog_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_delete AFTER DELETE ON blog_comment BEGIN "
+    "INSERT INTO blog_comment_fts(blog_comment_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS blog_comment_fts_update AFTER UPDATE OF content ON blog_comment BEGIN "
+    "INSERT INTO blog_comment_fts(blog_comment_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO blog_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+# The index and its columns per model, for index().
+COLUMNS = {
+    Article: ('blog_article_fts', ['title', 'content']),
+    Comment: ('blog_comment_fts', ['content']),
+}
+
+SEARCH_SQL = (
+    "SELECT * FROM ("
+    "SELECT 'article' AS type, blog_article.id AS id, blog_article.id AS article, "
+    "snippet(blog_article_fts, -1, char(2), char(3), '...', %(tokens)d) AS snippet, "
+    "bm25(blog_article_fts, 10.0, 1.0) AS rank "
+    "FROM blog_article_fts JOIN blog_article ON blog_article.id = blog_article_fts.rowid "
+    "WHERE blog_article_fts MATCH %%s AND blog_article.deleted_at IS NULL "
+    "UNION ALL "
+    "SELECT 'comment', blog_comment.id, blog_comment.article_id, "
+    "snippet(blog_comment_fts, 0, char(2), char(3), '...', %(tokens)d), bm25(blog_comment_fts) "
+    "FROM blog_comment_fts JOIN blog_comment ON blog_comment.id = blog_comment_fts.rowid "
+    "WHERE blog_comment_fts MATCH %%s AND blog_comment.deleted_at IS NULL"
+    ") %(after)s ORDER BY rank, type, id LIMIT %%s"
+)
+
+AFTER_SQL = "WHERE rank > %s OR (rank = %s AND (type > %s OR (type = %s AND id > %s)))"
+
+SNIPPET_TOKENS = 12
+
+START = '<mark>'
+END = '</mark>'
+
+_index_kind = {}
+
+def index_kind(connection):
+    """'plain' for the index of migration 0010, 'external' for that of 0004, or None."""
+    if connection.vendor != 'sqlite':
+        return None
+    if connection.alias not in _index_kind:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'blog_article_fts'")
+            row = cursor.fetchone()
+        # External-content tables name their content table.
+        _index_kind[connection.alias] = row and ('external' if 'content=' in row[0] else 'plain')
+    return _index_kind[connection.alias]
+
+def has_index(connection):
+    return index_kind(connection) is not None
+
+def install_triggers(sender, using, **kwargs):
+    """post_migrate receiver (re)creating the triggers that feed the index."""
+    connection = connections[using]
+    _index_kind.pop(using, None)
+    if has_index(connection):
+        with connection.cursor() as cursor:
+            for statement in TRIGGERS if index_kind(connection) == 'plain' else EXTERNAL_TRIGGERS:
+                cursor.execute(statement)
+
+def index(model, objs):
+    """
+    Indexes the objs of model (instances carrying the pk and every indexed
+    field) whose bodies may be stored compressed, which the triggers skip.
+    Call after writing them, in the same transaction.
+    """
+    table, columns = COLUMNS[model]
+    # As stored: the fields save str() whatever the API was sent.
+    rows = [[obj.pk] + [str(getattr(obj, column)) for column in columns] for obj in objs]
+    rows = [row for row in rows if compressible(row[-1])]
+    connection = connections[router.db_for_write(model)]
+    if not rows or index_kind(connection) != 'plain':
+        return
+    with connection.cursor() as cursor:
+        # A body that turned out not to shrink was stored as text and
+        # indexed by its trigger; replacing it again is harmless.
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % table, [row[:1] for row in rows])
+        cursor.executemany('INSERT INTO %s(rowid, %s) VALUES (%s)' % (table, ', '.join(columns), ', '.join(
+            ['%s'] * (len(columns) + 1))), rows)
+
+def encode_position(position):
+    return urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+def decode_position(cursor):
+    """Returns (rank, type, id) from a cursor. Raises ValueError if it is malformed."""
+    try:
+        rank, kind, pk = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (BinasciiError, UnicodeDecodeError, TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(rank, (int, float)) or kind not in ('article', 'comment') or not isinstance(pk, int):
+        raise ValueError('invalid cursor')
+    return rank, kind, bounded(pk)
+
+def terms(query):
+    return query.split()
+
+def match_expression(words):
+    # Each word becomes a quoted FTS5 string, so user input never reaches
+    # the query syntax; adjacent strings are ANDed.
+    return ' '.join('"%s"' % word.replace('"', '""') for word in words)
+
+def search(query, limit, after=None):
+    """
+    Returns (results, next_position) for the page of matches for query
+    following the position after.
+    """
+    words = terms(query)
+    connection = connections[Article.objects.db]
+    if has_index(connection):
+        match = match_expression(words)
+        params = [match, match]
+        if after:
+            rank, kind, pk = after
+            params += [rank, rank, kind, kind, pk]
+        sql = SEARCH_SQL % {'tokens': SNIPPET_TOKENS, 'after': AFTER_SQL if after else ''}
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit + 1])
+            rows = cursor.fetchall()
+        results = [{'type': row[0], 'id': row[1], 'article': row[2], 'snippet': highlight(row[3]), 'rank': row[4]}
+                   for row in rows]
+    else:
+        kind, pk = after[1:] if after else ('', 0)
+        results = scan(words, limit + 1, kind, pk)
+    next_position = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        next_position = [last['rank'], last['type'], last['id']]
+    return results, next_position
+
+def highlight(snippet):
+    return escape(snippet).replace('\x02', START).replace('\x03', END)
+
+def scan(words, limit, kind, pk):
+    """Unranked fallback: articles then comments, in id order."""
+    results = []
+    if kind in ('', 'article'):
+        condition = reduce(and_, (Q(title__icontains=word) | Q(content__icontains=word) for word in words))
+        articles = Article.objects.filter(condition, pk__gt=pk).order_by('pk')
+        for article_id, title, content in articles.values_list('id', 'title', 'content')[:limit]:
+            text = content if words[0].lower() in content.lower() else title
+            results.append({'type': 'article', 'id': article_id, 'article': article_id,
+                            'snippet': excerpt(text, words), 'rank': 0})
+        pk = 0
+    if len(results) < limit:
+        condition = reduce(and_, (Q(content__icontains=word) for word in words))
+        comments = Comment.objects.filter(condition, pk__gt=pk).order_by('pk')
+        for comment_id, article_id, content in comments.values_list('id', 'article', 'content')[:limit - len(results)]:
+            results.append({'type': 'comment', 'id': comment_id, 'article': article_id,
+                            'snippet': excerpt(content, words), 'rank': 0})
+    return results
+
+def excerpt(text, words, width=60):
+    start = max(text.lower().find(words[0].lower()) - width // 2, 0)
+    snippet = text[start:start + width]
+    lowered = snippet.lower()
+    marked = []
+    position = 0
+    while position < len(snippet):
+        hits = [(lowered.find(word.lower(), position), word) for word in words]
+        hits = [hit for hit in hits if hit[0] >= 0]
+        if not hits:
+            marked.append(escape(snippet[position:]))
+            break
+        index, word = min(hits)
+        marked.append(escape(snippet[position:index]))
+        marked.append(START + escape(snippet[index:index + len(word)]) + END)
+        position = index + len(word)
+    return ('...' if start else '') + ''.join(marked) + ('...' if start + width < len(text) else '')
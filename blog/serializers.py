@@ -0,0 +1,58 @@
+from operator import itemgetter
+from .content import SummaryField
+from .models import Article, Comment
+
+# Column-projected serialization for the API. Querysets are reduced with
+# values_list() so no model instances are built for list and detail reads,
+# and the output matches model_to_dict() key for key.
+
+class Serializer:
+    def __init__(self, model, fields):
+        self.model = model
+        self.all_fields = fields
+        self.summaries = {field.source: field.name for field in model._meta.concrete_fields
+                          if isinstance(field, SummaryField) and field.source in fields}
+
+    def select(self, request):
+        """
+        Returns the fields named by ?fields=, or every field when absent.
+        Raises ValueError on unknown names.
+        """
+        requested = request.GET.get('fields')
+        if not requested:
+            return self.all_fields
+        names = set(name.strip() for name in requested.split(','))
+        if not names <= set(self.all_fields):
+            raise ValueError('unknown field')
+        return tuple(name for name in self.all_fields if name in names)
+
+    def summarized(self, fields):
+        """fields with each body replaced by its stored summary, for ?summary=1 lists."""
+        return tuple(self.summaries.get(name, name) for name in fields)
+
+    def project(self, queryset, fields):
+        # 'id' always comes first so callers can page on row[0].
+        columns = fields if fields[0] == 'id' else ('id',) + fields
+        return queryset.values_list(*columns)
+
+    def row(self, fields):
+        """Returns a function turning a projected row into an output dict."""
+        if fields[0] == 'id':
+            return lambda values: dict(zip(fields, values))
+        return lambda values: dict(zip(fields, values[1:]))
+
+    def pick(self, data, fields):
+        return data if fields is self.all_fields else {name: data[name] for name in fields}
+
+    def instance(self, obj, fields=None):
+        meta = self.model._meta
+        fields = fields or self.all_fields
+        return {name: getattr(obj, meta.get_field(name).attname) for name in fields}
+
+row_key = itemgetter(0)
+
+def wants_summary(request):
+    return request.GET.get('summary') in ('1', 'true')
+
+article_serializer = Serializer(Article, ('id', 'title', 'content', 'author'))
+comment_serializer = Serializer(Comment, ('id', 'article', 'content', 'author'))
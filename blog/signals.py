@@ -0,0 +1,38 @@
+from django.apps import apps
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+from .cache import article_cache, comment_cache
+from .db import apply_pragmas, check_connections
+from .routers import unpin
+from .models import Article, Comment
+from .search import index, install_triggers
+
+@receiver(pre_save, sender=Article)
+@receiver(pre_save, sender=Comment)
+def bump_version(sender, instance, **kwargs):
+    # The API updates with version = version + 1 in SQL; saves of loaded
+    # rows (the shell, scripts) bump from the version they loaded.
+    if not instance._state.adding:
+        instance.version += 1
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+def invalidate_article(sender, instance, **kwargs):
+    article_cache.invalidate(instance.pk)
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment(sender, instance, **kwargs):
+    comment_cache.invalidate(instance.pk)
+
+@receiver(post_save, sender=Article)
+@receiver(post_save, sender=Comment)
+def index_body(sender, instance, **kwargs):
+    index(sender, [instance])
+
+post_migrate.connect(install_triggers, sender=apps.get_app_config('blog'))
+connection_created.connect(apply_pragmas)
+request_started.connect(check_connections)
+request_finished.connect(unpin)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+NDJSON = 'application/x-ndjson'
+
+def wants_stream(request):
+    return request.GET.get('stream') in ('1', 'true') or NDJSON in request.META.get('HTTP_ACCEPT', '')
+
+def wants_ndjson(request):
+    return NDJSON in request.META.get('HTTP_ACCEPT', '')
+
+def _encoded_chunks(queryset, serialize):
+    # Rows are read through a chunked cursor and encoded a chunk at a time,
+    # so memory stays flat however many rows the table holds.
+    chunk_size = getattr(settings, 'BLOG_STREAM_CHUNK_SIZE', 2000)
+    encoder = DjangoJSONEncoder()
+    chunk = []
+    for row in queryset.order_by('pk').iterator(chunk_size=chunk_size):
+        chunk.append(encoder.encode(serialize(row)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _ndjson(queryset, serialize):
+    for chunk in _encoded_chunks(queryset, serialize):
+        yield '\n'.join(chunk) + '\n'
+
+def _json_array(queryset, serialize):
+    yield '['
+    separator = ''
+    for chunk in _encoded_chunks(queryset, serialize):
+        yield separator + ','.join(chunk)
+        separator = ','
+    yield ']'
+
+def stream_response(request, queryset, serialize):
+    ndjson = wants_ndjson(request)
+    if ndjson:
+        return StreamingHttpResponse(_ndjson(queryset, serialize), content_type=NDJSON, status=200)
+    return StreamingHttpResponse(_json_array(queryset, serialize), content_type='application/json', status=200)
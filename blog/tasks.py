@@ -0,0 +1,124 @@
+import json
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from . import changes
+from .cache import article_cache, comment_cache
+from .models import Article, Comment, Task
+
+# Background jobs in the Task table, run by blog_worker. Enqueueing in the
+# transaction of a write makes the job commit, or roll back, with it. A
+# worker claims one due task at a time with a conditional UPDATE and a
+# lease of BLOG_TASK_LEASE seconds, so any number of workers can share the
+# table and a crashed worker's task runs again once its lease is up. A
+# task that raises is retried with exponential backoff up to
+# BLOG_TASK_MAX_ATTEMPTS times, then left failed for blog_worker --status.
+#
+# The API deletes by soft-delete: delete_later() hides the rows (an
+# article's comments with it, in one UPDATE) and enqueues a purge, which
+# deletes them a chunk per transaction so no request or job holds the
+# write lock long.
+
+def enqueue(name, delay=0, **payload):
+    return Task.objects.create(name=name, payload=json.dumps(payload),
+                               run_after=timezone.now() + timedelta(seconds=delay))
+
+def delete_later(queryset):
+    """Soft-deletes the rows of queryset, and the comments of its articles, and enqueues their purge. Returns how many."""
+    now = timezone.now()
+    pks = list(queryset.values_list('pk', flat=True))
+    if not pks:
+        return 0
+    model = queryset.model
+    model.objects.filter(pk__in=pks).update(deleted_at=now)
+    # update() sends no signals, so the detail caches are told directly.
+    if model is Article:
+        comments = Comment.objects.filter(article_id__in=pks)
+        comment_cache.invalidate_many(comments.values_list('pk', flat=True))
+        comments.update(deleted_at=now)
+        article_cache.invalidate_many(pks)
+    else:
+        comment_cache.invalidate_many(pks)
+    enqueue('purge', kind='article' if model is Article else 'comment', ids=pks)
+    return len(pks)
+
+def purge(kind, ids):
+    """Deletes one chunk of the soft-deleted rows, an article's comments first, and enqueues the rest."""
+    size = getattr(settings, 'BLOG_PURGE_CHUNK_SIZE', 500)
+    if kind == 'article':
+        comments = list(Comment.all_objects.filter(article_id__in=ids).values_list('pk', 'article_id')[:size])
+        if comments:
+            # The article's tombstone went into the change feed with its
+            # soft-delete; its comments' go in as they are purged.
+            changes.record(Comment, 'delete', comments)
+            Comment.all_objects.filter(pk__in=[pk for pk, article_id in comments]).delete()
+            enqueue('purge', kind=kind, ids=ids)
+        else:
+            Article.all_objects.filter(pk__in=ids, deleted_at__isnull=False).delete()
+    else:
+        Comment.all_objects.filter(pk__in=ids[:size], deleted_at__isnull=False).delete()
+        if ids[size:]:
+            enqueue('purge', kind=kind, ids=ids[size:])
+
+HANDLERS = {'purge': purge}
+
+def claim():
+    """Returns a due task, now leased to the caller, or None."""
+    now = timezone.now()
+    lease = timedelta(seconds=getattr(settings, 'BLOG_TASK_LEASE', 60))
+    # Pending tasks past run_after, and running ones past their lease.
+    due = Task.objects.filter(state__in=['pending', 'running'], run_after__lte=now)
+    for task in due.order_by('run_after', 'pk')[:10]:
+        # Another worker may claim it first; then its attempts have moved.
+        if Task.objects.filter(pk=task.pk, state=task.state, attempts=task.attempts).update(
+                state='running', attempts=task.attempts + 1, run_after=now + lease):
+            task.state, task.attempts, task.run_after = 'running', task.attempts + 1, now + lease
+            return task
+    return None
+
+def run(task):
+    """Runs a claimed task. Returns True if it succeeded, else schedules a retry or fails it."""
+    try:
+        # The task row goes with the job's writes, or stays with neither.
+        with transaction.atomic():
+            HANDLERS[task.name](**json.loads(task.payload))
+            task.delete()
+        return True
+    except Exception:
+        error = traceback.format_exc()
+    # Unless the lease ran out and another worker has claimed it since.
+    mine = Task.objects.filter(pk=task.pk, state='running', attempts=task.attempts)
+    if task.attempts >= getattr(settings, 'BLOG_TASK_MAX_ATTEMPTS', 5):
+        mine.update(state='failed', last_error=error)
+    else:
+        delay = getattr(settings, 'BLOG_TASK_RETRY_DELAY', 5) * 2 ** (task.attempts - 1)
+        mine.update(state='pending', last_error=error, run_after=timezone.now() + timedelta(seconds=delay))
+    return False
+
+def run_due(limit=None):
+    """Runs due tasks until none are left or limit have run. Returns (succeeded, failed)."""
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        task = claim()
+        if task is None:
+            break
+        if run(task):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
+
+def status():
+    """Returns {state: (tasks, oldest run_after)}."""
+    return {state: (count, oldest) for state, count, oldest in
+            Task.objects.order_by().values_list('state').annotate(Count('pk'), Min('run_after'))}
+
+def retry_failed():
+    """Makes every failed task due again with fresh attempts. Returns how many."""
+    return Task.objects.filter(state='failed').update(state='pending', attempts=0, run_after=timezone.now())
+
+def failed(limit=20):
+    return list(Task.objects.filter(state='failed').order_by('-pk')[:limit])
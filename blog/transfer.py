@@ -0,0 +1,328 @@
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+from django.contrib.auth.models import User
+from django.db import connections, reset_queries, router, transaction
+from django.db.models import Max, Min
+from django.utils.dateparse import parse_datetime
+from . import changes, counters, search
+from .models import Article, Comment
+from .routers import primary
+
+# Bulk export and import of users, articles and comments, for blog_export
+# and blog_import. An export is a directory of NDJSON or CSV files, one per
+# model and id range, plus manifest.json. Rows are read through chunked
+# cursors and written a batch per transaction with bulk_create, so memory
+# stays flat however many rows move; only the users' id map is held whole.
+#
+# Imported users are matched to existing ones by username. Imported
+# articles and comments keep their ids shifted past the target's highest
+# id (unchanged into an empty database): the block is reserved in the id
+# sequence up front, so parallel workers and live writers never collide,
+# and a comment's article is remapped by the same offset. Imports enter
+# the change feed batch by batch like API writes, and are counted towards
+# the stats counters once each model is in.
+
+MODELS = {'user': User, 'article': Article, 'comment': Comment}
+
+# (name, type) per column, in file order; 'author' and 'article' are ids.
+FIELDS = {
+    'user': [('id', int), ('username', str), ('password', str), ('email', str), ('first_name', str),
+             ('last_name', str), ('is_staff', bool), ('is_active', bool), ('is_superuser', bool),
+             ('date_joined', 'datetime'), ('last_login', 'datetime')],
+    'article': [('id', int), ('title', str), ('content', str), ('author', int), ('updated_at', 'datetime'),
+                ('version', int)],
+    'comment': [('id', int), ('article', int), ('content', str), ('author', int), ('updated_at', 'datetime'),
+                ('version', int)],
+}
+
+FORMATS = ('ndjson', 'csv')
+
+MANIFEST = 'manifest.json'
+
+class TransferError(Exception):
+    pass
+
+def _decode(kind, value):
+    if value is None or value == '' and kind is not str:
+        return None
+    if kind == 'datetime':
+        return parse_datetime(value) if isinstance(value, str) else value
+    if kind is bool and isinstance(value, str):
+        return value in ('1', 'True', 'true')
+    return kind(value)
+
+def write_rows(fmt, path, rows, names):
+    """Writes rows, tuples of names' values, to path. Returns how many."""
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as stream:
+        if fmt == 'csv':
+            writer = csv.writer(stream, lineterminator='\n')
+            writer.writerow(names)
+            for row in rows:
+                writer.writerow(['' if value is None else int(value) if isinstance(value, bool) else
+                                 value.isoformat() if hasattr(value, 'isoformat') else value for value in row])
+                count += 1
+        else:
+            # Full isoformat(): DjangoJSONEncoder would cut timestamps to milliseconds.
+            encoder = json.JSONEncoder(ensure_ascii=False, default=lambda value: value.isoformat())
+            for row in rows:
+                stream.write(encoder.encode(dict(zip(names, row))))
+                stream.write('\n')
+                count += 1
+    return count
+
+def read_rows(fmt, path, fields):
+    """Yields the rows in path as dicts of typed values."""
+    with open(path, encoding='utf-8', newline='') as stream:
+        if fmt == 'csv':
+            # Bodies may be longer than the csv module's 128 kB default.
+            csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+            rows = csv.DictReader(stream)
+        else:
+            rows = (json.loads(line) for line in stream if line.strip())
+        for row in rows:
+            try:
+                yield {name: _decode(kind, row[name]) for name, kind in fields}
+            except (KeyError, TypeError, ValueError) as e:
+                raise TransferError('%s: bad row %r: %s' % (path, row, e))
+
+class Progress:
+    """Rows done by this process and any workers forked from it, reported every interval seconds."""
+
+    def __init__(self, label, write, interval):
+        self.label = label
+        self.write = write
+        self.interval = interval
+        self.rows = multiprocessing.get_context('fork').Value('q', 0)
+        self.start = self.last = time.perf_counter()
+
+    def add(self, count):
+        with self.rows.get_lock():
+            self.rows.value += count
+
+    def report(self, done=False):
+        now = time.perf_counter()
+        if not done and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        self.write('%s: %d rows%s in %.1f s, %.0f rows/s' % (
+            self.label, self.rows.value, '' if done else ' so far', elapsed, self.rows.value / max(elapsed, 1e-9)))
+
+_worker = {}
+
+def _init_worker(progress, state):
+    _worker['progress'] = progress
+    _worker.update(state)
+
+def run_parts(function, parts, workers, progress, **state):
+    """
+    Runs function(*part) for every part, in workers forked processes when
+    more than one, and returns the results. state is handed to every call
+    through _worker, by inheritance rather than pickling.
+    """
+    if workers <= 1 or len(parts) <= 1:
+        _init_worker(progress, state)
+        return [function(*part) for part in parts]
+    # Each worker opens its own connections.
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(parts)), _init_worker, (progress, state)) as pool:
+        result = pool.starmap_async(function, parts)
+        while not result.ready():
+            result.wait(min(progress.interval, 1))
+            progress.report()
+        return result.get()
+
+def _tick(count):
+    # Under DEBUG, connections keep the SQL of their last 9000 queries,
+    # bulk inserts included.
+    reset_queries()
+    progress = _worker['progress']
+    progress.add(count)
+    if multiprocessing.parent_process() is None:
+        progress.report()
+
+# Export.
+
+def _ranges(model, parts):
+    bounds = model.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return [(0, 0)]
+    low, high = bounds['low'], bounds['high'] + 1
+    step = -(-(high - low) // parts)
+    return [(start, min(start + step, high)) for start in range(low, high, step)]
+
+def _export_part(kind, path, low, high):
+    names = [name for name, _ in FIELDS[kind]]
+    queryset = MODELS[kind].objects.filter(pk__gte=low, pk__lt=high).order_by('pk').values_list(*names)
+    chunk_size = _worker['chunk_size']
+    max_id = 0
+
+    def rows():
+        nonlocal max_id
+        iterator = queryset.iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield from chunk
+            max_id = chunk[-1][0]
+            _tick(len(chunk))
+
+    with primary():
+        count = write_rows(_worker['format'], path, rows(), names)
+    return count, max_id
+
+def export(directory, fmt, workers=1, chunk_size=2000, write=print, interval=5):
+    """Writes the live users, articles and comments to directory. Returns the manifest."""
+    if fmt not in FORMATS:
+        raise TransferError('unknown format %r' % fmt)
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'format': fmt, 'models': {}}
+    for kind, model in MODELS.items():
+        with primary():
+            ranges = _ranges(model, workers)
+        parts = [(kind, os.path.join(directory, '%s.%d.%s' % (kind, number, fmt)), low, high)
+                 for number, (low, high) in enumerate(ranges)]
+        progress = Progress(kind, write, interval)
+        results = run_parts(_export_part, parts, workers, progress, format=fmt, chunk_size=chunk_size)
+        progress.report(done=True)
+        manifest['models'][kind] = {
+            'parts': [os.path.basename(part[1]) for part in parts],
+            'rows': sum(count for count, max_id in results),
+            'max_id': max((max_id for count, max_id in results), default=0),
+        }
+    with open(os.path.join(directory, MANIFEST), 'w') as stream:
+        json.dump(manifest, stream, indent=2)
+    return manifest
+
+# Import.
+
+def reserve_ids(model, count):
+    """
+    Moves model's id sequence count ids past the highest id in use, and
+    returns that id: ids offset + 1 to offset + count are then free.
+    """
+    table = model._meta.db_table
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT MAX(%s) FROM %s' % (qn(model._meta.pk.column), qn(table)))
+            high = cursor.fetchone()[0] or 0
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            offset = max(high, row[0] if row else 0)
+            if row:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [offset + count, table])
+            else:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, offset + count])
+        elif connection.vendor == 'postgresql':
+            sequence = "pg_get_serial_sequence('%s', '%s')" % (table, model._meta.pk.column)
+            cursor.execute('SELECT setval(%s, GREATEST((SELECT COALESCE(MAX(%s), 0) FROM %s), nextval(%s)) + %%s) - %%s' % (
+                sequence, qn(model._meta.pk.column), qn(table), sequence), [count, count])
+            offset = cursor.fetchone()[0]
+        else:
+            raise TransferError('cannot reserve ids on %s' % connection.vendor)
+    return offset
+
+@contextmanager
+def _keeping_timestamps(model):
+    # The exported updated_at is kept; auto_now would overwrite it.
+    field = model._meta.get_field('updated_at')
+    field.auto_now = False
+    try:
+        yield
+    finally:
+        field.auto_now = True
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _import_users(fmt, path):
+    """Creates the users whose usernames are new. Returns {exported id: id here} for all of them."""
+    authors = {}
+    offset = _worker['offsets']['user']
+    for batch in _batches(read_rows(fmt, path, FIELDS['user']), _worker['batch_size']):
+        existing = dict(User.objects.filter(username__in=[row['username'] for row in batch])
+                        .values_list('username', 'pk'))
+        fresh = [User(**dict(row, id=row['id'] + offset)) for row in batch if row['username'] not in existing]
+        with transaction.atomic():
+            User.objects.bulk_create(fresh)
+        for row in batch:
+            authors[row['id']] = existing.get(row['username'], row['id'] + offset)
+        _tick(len(batch))
+    return authors
+
+def _import_part(kind, path):
+    """Inserts the articles or comments in path. Returns how many were skipped for a missing author or article."""
+    model = MODELS[kind]
+    offsets, authors = _worker['offsets'], _worker['authors']
+    skipped = 0
+    for batch in _batches(read_rows(_worker['format'], path, FIELDS[kind]), _worker['batch_size']):
+        if kind == 'comment':
+            # An article deleted while the export ran leaves its comments behind.
+            articles = set(Article.all_objects.filter(
+                pk__in=[row['article'] + offsets['article'] for row in batch]).values_list('pk', flat=True))
+        objs = []
+        for row in batch:
+            row['id'] += offsets[kind]
+            row['author_id'] = authors.get(row.pop('author'))
+            if kind == 'comment':
+                row['article_id'] = row.pop('article') + offsets['article']
+                if row['article_id'] not in articles:
+                    row['author_id'] = None
+            if row['author_id'] is None:
+                skipped += 1
+                continue
+            objs.append(model(**row))
+        with transaction.atomic(), _keeping_timestamps(model):
+            model.objects.bulk_create(objs)
+            search.index(model, objs)
+            changes.record(model, 'create', [(obj.pk, getattr(obj, 'article_id', None)) for obj in objs])
+        _tick(len(batch))
+    return skipped
+
+def load(directory, workers=1, batch_size=1000, write=print, interval=5):
+    """Imports an export from directory. Returns {model: (rows imported, rows skipped)}."""
+    try:
+        with open(os.path.join(directory, MANIFEST)) as stream:
+            manifest = json.load(stream)
+    except (OSError, ValueError) as e:
+        raise TransferError('no readable %s in %s: %s' % (MANIFEST, directory, e))
+    fmt = manifest['format']
+    models = manifest['models']
+    offsets = {kind: reserve_ids(model, models[kind]['max_id']) for kind, model in MODELS.items()}
+    state = {'format': fmt, 'batch_size': batch_size, 'offsets': offsets}
+    totals = {}
+
+    progress = Progress('user', write, interval)
+    _init_worker(progress, state)
+    authors = {}
+    for name in models['user']['parts']:
+        authors.update(_import_users(fmt, os.path.join(directory, name)))
+    progress.report(done=True)
+    totals['user'] = (progress.rows.value, 0)
+
+    for kind in ('article', 'comment'):
+        progress = Progress(kind, write, interval)
+        parts = [(kind, os.path.join(directory, name)) for name in models[kind]['parts']]
+        skipped = sum(run_parts(_import_part, parts, workers, progress, authors=authors, **state))
+        # Counted once the whole model is in, with a few grouped queries.
+        with transaction.atomic():
+            counters.imported(MODELS[kind], offsets[kind] + 1, offsets[kind] + models[kind]['max_id'])
+        progress.report(done=True)
+        totals[kind] = (progress.rows.value - skipped, skipped)
+    return totals
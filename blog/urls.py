@@ -7,7 +7,15 @@ urlpatterns = [
     path('signin/', views.signin, name='signin'),
     path('signout/', views.signout, name='signout'),
     path('article/', views.article, name='article'),
+    path('article/bulk/', views.article_bulk, name='article_bulk'),
     path('article/<int:article_id>/', views.article_detail, name='article_detail'),
+    path('comment/bulk/', views.comment_bulk, name='comment_bulk'),
     path('comment/<int:comment_id>/', views.comment_detail, name='comment_detail'),
     path('article/<int:article_id>/comment/', views.article_comment, name='article_comment'),
+    path('article/<int:article_id>/comment/stream/', views.article_comment_stream, name='article_comment_stream'),
+    path('article/<int:article_id>/stats/', views.article_stats, name='article_stats'),
+    path('user/<int:user_id>/stats/', views.user_stats, name='user_stats'),
+    path('changes/', views.change_feed, name='changes'),
+    path('search/', views.search, name='search'),
+    path('_metrics', views.metrics, name='metrics'),
 ]
@@ -1,13 +1,24 @@
+from django.conf import settings
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
-import json
-from django.contrib.auth.models import User
-from .models import Article, Comment
-from json import JSONDecodeError
-from django.shortcuts import get_object_or_404
-from django.forms.models import model_to_dict
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
+from .models import Article, ArticleStats, AuthorStats, Comment
+from .access import VersionConflict, check_exists, check_owner, delete_owned, parse_body, update_owned
+from .pagination import MAX_INT, get_limit, paginate, set_page_links
+from .search import decode_position, encode_position, search as search_index
+from .streaming import stream_response, wants_stream
+from .serializers import article_serializer, comment_serializer, row_key, wants_summary
+from .cache import article_cache, comment_cache
+from .bulk import ItemError, bulk_create, bulk_delete, bulk_update, parse_items
+from .includes import ArticleIncludes
+from .conditional import collection_validators, detail_etag, if_match_versions, make_etag, not_modified, set_validators
+from .hashing import HashingBusy, hashing_pool, service_unavailable
+from .metrics import registry, timer
+from .events import HubFull, stream_response as event_stream_response
+from . import changes, counters
 
 @ensure_csrf_cookie
 def token(request):
@@ -19,12 +30,14 @@ def token(request):
 def signup(request):
     if request.method == 'POST':
         try:
-            req_data = json.loads(request.body.decode())
-            username = req_data['username']
-            password = req_data['password']
-        except (KeyError, JSONDecodeError) as e:
+            username, password = parse_body(request, 'username', 'password')
+        except ValueError:
             return HttpResponseBadRequest()
-        User.objects.create_user(username=username, password=password)
+        try:
+            with hashing_pool.slot('signup'):
+                User.objects.create_user(username=username, password=password)
+        except HashingBusy:
+            return service_unavailable()
         return HttpResponse(status=201)
     else:
         return HttpResponseNotAllowed(['POST'])
@@ -32,12 +45,14 @@ def signup(request):
 def signin(request):
     if request.method == 'POST':
         try:
-            req_data = json.loads(request.body.decode())
-            username = req_data['username']
-            password = req_data['password']
-        except (KeyError, JSONDecodeError) as e:
+            username, password = parse_body(request, 'username', 'password')
+        except ValueError:
             return HttpResponseBadRequest()
-        user = authenticate(request, username=username, password=password)
+        try:
+            with hashing_pool.slot('signin'):
+                user = authenticate(request, username=username, password=password)
+        except HashingBusy:
+            return service_unavailable()
         if user is not None:
             login(request, user)
             return HttpResponse(status=204)
@@ -56,130 +71,317 @@ def signout(request):
     else:
         return HttpResponseNotAllowed(['GET'])
 
+def list_response(request, queryset, serializer, includes=None):
+    state = list(collection_validators(queryset.model))
+    if includes is not None:
+        state += includes.validators()
+    etag = make_etag(request, *state)
+    # The ETag alone; see blog.conditional.
+    response = not_modified(request, etag, None)
+    if response is None:
+        try:
+            fields = serializer.select(request)
+            if wants_summary(request):
+                fields = serializer.summarized(fields)
+            projected = serializer.project(queryset, fields)
+            to_dict = serializer.row(fields)
+            if wants_stream(request):
+                if includes is not None:
+                    raise ValueError('includes are not streamed')
+                response = stream_response(request, projected, to_dict)
+            else:
+                rows, next_cursor, prev_cursor = paginate(request, projected, key=row_key)
+                with timer('serialize'):
+                    data = [to_dict(row) for row in rows]
+                if includes is not None:
+                    includes.expand([row_key(row) for row in rows], data)
+                with timer('serialize'):
+                    response = JsonResponse(data, safe=False, status=200)
+                set_page_links(request, response, next_cursor, prev_cursor)
+        except ValueError:
+            return HttpResponseBadRequest()
+    return set_validators(response, etag, None)
+
+def detail_response(request, object_cache, object_id, serializer):
+    try:
+        fields = serializer.select(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    data, last_modified, version = object_cache.get(object_id)
+    etag = detail_etag(request, object_id, version)
+    response = not_modified(request, etag, last_modified)
+    if response is None:
+        with timer('serialize'):
+            response = JsonResponse(serializer.pick(data, fields), status=200)
+    return set_validators(response, etag, last_modified)
+
+def updated_response(request, object_id, data, version):
+    response = JsonResponse(data, status=201)
+    if version is not None:
+        # The tag a GET of the same URL now returns, for the next If-Match.
+        response['ETag'] = detail_etag(request, object_id, version)
+    return response
+
 def article(request):
     if request.method == 'GET':
         if request.user.is_authenticated:
-            article_all_list = [model_to_dict(article) for article in Article.objects.all()]
-            return JsonResponse(article_all_list, safe=False, status=200)
+            try:
+                includes = ArticleIncludes.from_request(request)
+            except ValueError:
+                return HttpResponseBadRequest()
+            return list_response(request, Article.objects.all(), article_serializer, includes)
         else:
             return HttpResponse(status=401)
     elif request.method == 'POST':
         if request.user.is_authenticated:
             try:
-                body = request.body.decode()
-                article_title = json.loads(body)['title']
-                article_content = json.loads(body)['content']
-            except (KeyError, JSONDecodeError) as e:
+                title, content = parse_body(request, 'title', 'content')
+            except ValueError:
                 return HttpResponseBadRequest()
-            article = Article(title=article_title, content=article_content, author=request.user)
-            article.save()
-            return JsonResponse(model_to_dict(article), status=201)
-
+            article = Article(title=title, content=content, author=request.user)
+            with transaction.atomic():
+                article.save()
+                counters.created(Article, [article])
+                changes.record(Article, 'create', [(article.pk, None)])
+            return JsonResponse(article_serializer.instance(article), status=201)
         else:
             return HttpResponse(status=401)
     else:
         return HttpResponseNotAllowed(['GET', 'POST'])
 
 def article_detail(request, article_id):
-
     if request.method == 'GET':
         if request.user.is_authenticated:
-            article = get_object_or_404(Article, pk=article_id)
-            return JsonResponse(model_to_dict(article), status=200)
+            return detail_response(request, article_cache, article_id, article_serializer)
         else:
             return HttpResponse(status=401)
-
     elif request.method == 'PUT':
         if request.user.is_authenticated:
-            article = get_object_or_404(Article, pk=article_id)
-            if article.author == request.user: 
-                try:
-                    body = request.body.decode()
-                    article_title = json.loads(body)['title']
-                    article_content = json.loads(body)['content']
-                except (KeyError, JSONDecodeError) as e:
-                    return HttpResponseBadRequest()
-                article.title = article_title
-                article.content=article_content
-                article.save()
-                return JsonResponse(model_to_dict(article), status=201)
-            else:
-                return HttpResponseForbidden()
+            try:
+                title, content = parse_body(request, 'title', 'content')
+            except ValueError:
+                check_owner(Article, article_id, request.user)
+                return HttpResponseBadRequest()
+            try:
+                version = update_owned(Article, article_cache, article_id, request.user, if_match_versions(request),
+                                       title=title, content=content)
+            except VersionConflict:
+                return HttpResponse(status=412)
+            article = Article(pk=article_id, title=title, content=content, author_id=request.user.pk)
+            return updated_response(request, article_id, article_serializer.instance(article), version)
         else:
             return HttpResponse(status=401)
     elif request.method == 'DELETE':
         if request.user.is_authenticated:
-            article = get_object_or_404(Article, pk=article_id)
-            if article.author == request.user: 
-                article.delete()
-                return HttpResponse(status=200)
-            else:
-                return HttpResponseForbidden()
+            delete_owned(Article, article_id, request.user)
+            return HttpResponse(status=200)
         else:
             return HttpResponse(status=401)
     else:
         return HttpResponseNotAllowed(['GET', 'PUT', 'DELETE'])
 
 def comment_detail(request, comment_id):
-
     if request.method == 'GET':
         if request.user.is_authenticated:
-            comment = get_object_or_404(Comment, pk=comment_id)
-            return JsonResponse(model_to_dict(comment), status=200)
+            return detail_response(request, comment_cache, comment_id, comment_serializer)
         else:
             return HttpResponse(status=401)
-
     elif request.method == 'PUT':
         if request.user.is_authenticated:
-            comment = get_object_or_404(Comment, pk=comment_id)
-            if comment.author == request.user: 
-                try:
-                    body = request.body.decode()
-                    comment_content = json.loads(body)['content']
-                except (KeyError, JSONDecodeError) as e:
-                    return HttpResponseBadRequest()
-                comment.content=comment_content
-                comment.save()
-                return JsonResponse(model_to_dict(comment), status=201)
-            else:
-                return HttpResponseForbidden()
+            article_id, = check_owner(Comment, comment_id, request.user, 'article_id')
+            try:
+                content, = parse_body(request, 'content')
+            except ValueError:
+                return HttpResponseBadRequest()
+            try:
+                version = update_owned(Comment, comment_cache, comment_id, request.user, if_match_versions(request),
+                                       parent=article_id, content=content)
+            except VersionConflict:
+                return HttpResponse(status=412)
+            comment = Comment(pk=comment_id, article_id=article_id, content=content, author_id=request.user.pk)
+            return updated_response(request, comment_id, comment_serializer.instance(comment), version)
         else:
             return HttpResponse(status=401)
     elif request.method == 'DELETE':
         if request.user.is_authenticated:
-            comment = get_object_or_404(Comment, pk=comment_id)
-            if comment.author == request.user: 
-                comment.delete()
-                return HttpResponse(status=200)
-            else:
-                return HttpResponseForbidden()
+            delete_owned(Comment, comment_id, request.user)
+            return HttpResponse(status=200)
         else:
             return HttpResponse(status=401)
     else:
-        return HttpResponseNotAllowed(['GET', 'POST'])
+        return HttpResponseNotAllowed(['GET', 'PUT', 'DELETE'])
 
 def article_comment(request, article_id):
-    
     if request.method == 'GET':
         if request.user.is_authenticated:
-            article = get_object_or_404(Article, pk=article_id)
-            comment_all_list = [model_to_dict(comment) for comment in article.comment_set.all()]
-            return JsonResponse(comment_all_list, safe=False, status=200)
+            check_exists(Article, article_id)
+            return list_response(request, Comment.objects.filter(article_id=article_id), comment_serializer)
         else:
             return HttpResponse(status=401)
-            
     elif request.method == 'POST':
         if request.user.is_authenticated:
-            article = get_object_or_404(Article, pk=article_id)
+            check_exists(Article, article_id)
             try:
-                body = request.body.decode()
-                comment_content = json.loads(body)['content']
-            except (KeyError, JSONDecodeError) as e:
+                content, = parse_body(request, 'content')
+            except ValueError:
                 return HttpResponseBadRequest()
-            comment = Comment(article=article, content=comment_content, author=request.user)
-            comment.save()
-            return JsonResponse(model_to_dict(comment), status=201)
+            comment = Comment(article_id=article_id, content=content, author=request.user)
+            with transaction.atomic():
+                comment.save()
+                counters.created(Comment, [comment])
+                changes.record(Comment, 'create', [(comment.pk, article_id)])
+            return JsonResponse(comment_serializer.instance(comment), status=201)
         else:
             return HttpResponse(status=401)
     else:
         return HttpResponseNotAllowed(['GET', 'POST'])
+
+def article_comment_stream(request, article_id):
+    if request.method == 'GET':
+        if request.user.is_authenticated:
+            check_exists(Article, article_id)
+            try:
+                subscription = changes.subscribe_comments(request, article_id)
+            except ValueError:
+                return HttpResponseBadRequest()
+            except HubFull:
+                response = HttpResponse(status=503)
+                response['Retry-After'] = getattr(settings, 'BLOG_EVENTS_RETRY_AFTER', 5)
+                return response
+            return event_stream_response(subscription)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+def article_stats(request, article_id):
+    if request.method == 'GET':
+        if request.user.is_authenticated:
+            try:
+                top = counters.get_top(request)
+            except ValueError:
+                return HttpResponseBadRequest()
+            comments = ArticleStats.objects.filter(article_id=article_id).values_list('comments', flat=True).first()
+            if comments is None:
+                # Never commented on, or not an article at all.
+                check_exists(Article, article_id)
+                comments, commenters = 0, []
+            else:
+                commenters = [{'author': author_id, 'comments': count}
+                              for author_id, count in counters.top_commenters(article_id, top)]
+            return JsonResponse({'article': article_id, 'comments': comments, 'top_commenters': commenters}, status=200)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+def user_stats(request, user_id):
+    if request.method == 'GET':
+        if request.user.is_authenticated:
+            counts = AuthorStats.objects.filter(user_id=user_id).values_list('articles', 'comments').first()
+            if counts is None:
+                check_exists(User, user_id)
+                counts = (0, 0)
+            return JsonResponse({'user': user_id, 'articles': counts[0], 'comments': counts[1]}, status=200)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+def article_bulk(request):
+    if request.method in ('POST', 'PUT', 'DELETE'):
+        if request.user.is_authenticated:
+            try:
+                items = parse_items(request.body.decode())
+            except ValueError:
+                return HttpResponseBadRequest()
+            if request.method == 'POST':
+                build = lambda item: Article(title=item['title'], content=item['content'], author=request.user)
+                results = bulk_create(Article, article_serializer, request.user, items, build)
+            elif request.method == 'PUT':
+                results = bulk_update(article_serializer, article_cache, request.user, items, ('title', 'content'))
+            else:
+                results = bulk_delete(article_serializer, request.user, items)
+            return JsonResponse(results, safe=False, status=200)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['POST', 'PUT', 'DELETE'])
+
+def comment_bulk(request):
+    if request.method in ('POST', 'PUT', 'DELETE'):
+        if request.user.is_authenticated:
+            try:
+                items = parse_items(request.body.decode())
+            except ValueError:
+                return HttpResponseBadRequest()
+            if request.method == 'POST':
+                article_ids = [item.get('article') for item in items if isinstance(item, dict)]
+                articles = set(Article.objects.filter(
+                    pk__in=[pk for pk in article_ids if isinstance(pk, int) and abs(pk) <= MAX_INT]).values_list('pk', flat=True))
+
+                def build(item):
+                    if item['article'] not in articles:
+                        raise ItemError(404)
+                    return Comment(article_id=item['article'], content=item['content'], author=request.user)
+
+                results = bulk_create(Comment, comment_serializer, request.user, items, build)
+            elif request.method == 'PUT':
+                results = bulk_update(comment_serializer, comment_cache, request.user, items, ('content',))
+            else:
+                results = bulk_delete(comment_serializer, request.user, items)
+            return JsonResponse(results, safe=False, status=200)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['POST', 'PUT', 'DELETE'])
+
+def change_feed(request):
+    if request.method == 'GET':
+        if request.user.is_authenticated:
+            try:
+                since, wait = changes.parse_since(request)
+                limit = get_limit(request)
+            except ValueError:
+                return HttpResponseBadRequest()
+            page = changes.get_page(since, limit, wait)
+            with timer('serialize'):
+                return JsonResponse(page, status=200)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+def search(request):
+    if request.method == 'GET':
+        if request.user.is_authenticated:
+            query = request.GET.get('q', '')
+            if not query.split():
+                return HttpResponseBadRequest()
+            try:
+                limit = get_limit(request)
+                after = request.GET.get('after')
+                results, next_position = search_index(query, limit, decode_position(after) if after else None)
+            except ValueError:
+                return HttpResponseBadRequest()
+            with timer('serialize'):
+                response = JsonResponse(results, safe=False, status=200)
+            next_cursor = encode_position(next_position) if next_position else None
+            return set_page_links(request, response, next_cursor, None)
+        else:
+            return HttpResponse(status=401)
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+def metrics(request):
+    if request.method == 'GET':
+        token = getattr(settings, 'BLOG_METRICS_TOKEN', None)
+        scraper = token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+        if not scraper:
+            if not request.user.is_authenticated:
+                return HttpResponse(status=401)
+            if not request.user.is_staff:
+                return HttpResponse(status=403)
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    else:
+        return HttpResponseNotAllowed(['GET'])
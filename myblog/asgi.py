@@ -0,0 +1,159 @@
+"""
+ASGI config for myblog project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+Django 2.2 has no ASGI handler of its own, so the WSGI application is
+adapted here: request bodies are read and responses written on the event
+loop, and Django itself runs on a bounded pool of ASGI_THREADS threads.
+A slow client therefore holds a socket, not a worker thread. Responses
+carrying an ``async_content`` generator (the event streams) are streamed
+from it on the event loop, so an idle stream holds no thread either.
+
+Serve it with any ASGI server, e.g. ``uvicorn myblog.asgi:application``.
+"""
+
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myblog.settings')
+
+
+class ThreadPoolASGIHandler:
+    def __init__(self, wsgi_application, max_workers):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('unsupported scope type %r' % scope['type'])
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            loop = asyncio.get_event_loop()
+            response = await loop.run_in_executor(self.executor, self.run, scope, body, send, loop)
+        if response is not None:
+            try:
+                await self.stream(response.async_content(), receive, send)
+            finally:
+                await loop.run_in_executor(self.executor, response.close)
+
+    async def stream(self, chunks, receive, send):
+        """Sends chunks until they end or the client disconnects."""
+        disconnected = asyncio.ensure_future(self.disconnect(receive))
+        chunk = None
+        try:
+            while True:
+                chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait([chunk, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    return
+                try:
+                    body = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if chunk is not None and not chunk.done():
+                # The generator cannot be closed while a step of it runs.
+                chunk.cancel()
+                await asyncio.wait([chunk])
+            await chunks.aclose()
+
+    async def disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, scope, body, send, loop):
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            send_sync({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                # Django emits Set-Cookie values with a leading space, which
+                # WSGI servers tolerate and HTTP/1.1 parsers reject.
+                'headers': [(name.lower().encode('latin1'), value.strip().encode('latin1'))
+                            for name, value in headers],
+            })
+
+        response = self.wsgi_application(self.environ(scope, body), start_response)
+        if getattr(response, 'async_content', None) is not None:
+            # Streamed on the event loop by __call__, which closes it.
+            return response
+        try:
+            for chunk in response:
+                if chunk:
+                    send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    def environ(self, scope, body):
+        script_name = scope.get('root_path', '')
+        path_info = scope['path']
+        if script_name and path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name.encode('utf8').decode('latin1'),
+            'PATH_INFO': path_info.encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('latin1'),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            # Responses with async_content are streamed on the event loop.
+            'blog.async_content': True,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+            environ[name] = value
+        return environ
+
+
+wsgi_application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402; configured by get_wsgi_application()
+
+application = ThreadPoolASGIHandler(wsgi_application, settings.BLOG_WORKER_THREADS)
@@ -41,13 +41,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'blog.middleware.InstrumentationMiddleware',
+    'blog.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'blog.middleware.ReadYourWritesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'blog.middleware.AdmissionMiddleware',
+    'blog.middleware.HashingBusyMiddleware',
 ]
 
 ROOT_URLCONF = 'myblog.urls'
@@ -74,14 +79,120 @@ WSGI_APPLICATION = 'myblog.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# BLOG_DB_PROFILE (environment) selects the database:
+#   'sqlite'        the project file, WAL journal, a busy timeout and write
+#                   transactions that wait for the lock (default)
+#   'sqlite-plain'  the same file with Django's and SQLite's defaults
+#   'postgres'      PostgreSQL from BLOG_DB_NAME/USER/PASSWORD/HOST/PORT; set
+#                   BLOG_DB_PGBOUNCER=1 when HOST is a PgBouncer pool
+# Connections persist for BLOG_DB_CONN_MAX_AGE seconds and are checked for
+# usability at the start of each request.
+
+BLOG_DB_PROFILE = os.environ.get('BLOG_DB_PROFILE', 'sqlite')
+
+BLOG_DB_CONN_MAX_AGE = int(os.environ.get('BLOG_DB_CONN_MAX_AGE', 60))
+
+BLOG_DB_HEALTH_CHECKS = True
+
+if BLOG_DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('BLOG_DB_NAME', 'myblog'),
+            'USER': os.environ.get('BLOG_DB_USER', ''),
+            'PASSWORD': os.environ.get('BLOG_DB_PASSWORD', ''),
+            'HOST': os.environ.get('BLOG_DB_HOST', ''),
+            'PORT': os.environ.get('BLOG_DB_PORT', ''),
+            'CONN_MAX_AGE': BLOG_DB_CONN_MAX_AGE,
+            # Transaction-mode PgBouncer cannot keep a named cursor open
+            # across transactions.
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('BLOG_DB_PGBOUNCER') == '1',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3' if BLOG_DB_PROFILE == 'sqlite-plain' else 'blog.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'CONN_MAX_AGE': BLOG_DB_CONN_MAX_AGE,
+        }
     }
+
+# Read replicas: BLOG_DB_REPLICAS (environment) lists replica databases,
+# comma-separated: SQLite file paths, or Postgres host names under the
+# postgres profile. Each becomes an alias replica1, replica2, ... Blog reads
+# go to a replica except for a client's own writes and the
+# BLOG_REPLICA_PIN_SECONDS after them. To try it with SQLite, point it at a
+# copy of db.sqlite3 and re-copy to "replicate".
+
+BLOG_DB_REPLICAS = []
+
+for number, replica in enumerate(filter(None, os.environ.get('BLOG_DB_REPLICAS', '').split(',')), 1):
+    alias = 'replica%d' % number
+    DATABASES[alias] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    DATABASES[alias]['HOST' if BLOG_DB_PROFILE == 'postgres' else 'NAME'] = replica
+    BLOG_DB_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['blog.routers.ReplicaRouter']
+
+BLOG_REPLICA_PIN_SECONDS = 5
+
+# Applied to every new SQLite connection. journal_mode is stored in the
+# database file, so 'sqlite-plain' sets it back explicitly.
+
+if BLOG_DB_PROFILE == 'sqlite-plain':
+    BLOG_SQLITE_PRAGMAS = {'journal_mode': 'delete'}
+else:
+    BLOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 10000,
+        'mmap_size': 64 * 1024 * 1024,
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
 }
 
 
+# Sessions
+# BLOG_SESSION_MODE picks the storage: 'db', 'cached_db' (db behind the
+# sessions cache), 'cache' (the sessions cache alone; an in-process LRU, so
+# sessions do not survive restarts or span processes) or 'signed_cookies'
+# (no server storage; logout cannot revoke a copied cookie).
+# Compare them with `python manage.py blog_session_bench`.
+
+BLOG_SESSION_MODE = 'db'
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + BLOG_SESSION_MODE
+
+SESSION_CACHE_ALIAS = 'sessions'
+
+
+# Password hashing
+# Django's defaults, with PBKDF2 computed on the blog's bounded hashing pool
+# for every caller (the admin and auth commands included); a hash the pool
+# refuses is answered with 503 by blog.middleware.HashingBusyMiddleware.
+
+PASSWORD_HASHERS = [
+    'blog.hashing.PooledPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -119,3 +230,171 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.2/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Blog API pagination
+# Keyset pages for the article and comment list endpoints
+
+BLOG_PAGE_SIZE = 20
+
+BLOG_MAX_PAGE_SIZE = 100
+
+# Rows fetched and encoded per chunk by ?stream=1 / NDJSON exports
+
+BLOG_STREAM_CHUNK_SIZE = 2000
+
+# Read-through cache for article and comment detail reads
+
+BLOG_CACHE_ALIAS = 'default'
+
+BLOG_CACHE_TIMEOUT = 300
+
+BLOG_CACHE_LOCAL_SIZE = 1024
+
+# Largest batch accepted by the bulk article and comment endpoints
+
+BLOG_BULK_MAX_ITEMS = 1000
+
+# Largest K accepted by ?include=recent_comments=K on the article list
+
+BLOG_MAX_RECENT_COMMENTS = 20
+
+# Largest ?top= accepted by /api/article/<id>/stats/
+
+BLOG_MAX_TOP_COMMENTERS = 20
+
+# Threads serving requests in each process: the pool myblog.asgi runs
+# Django on (ASGI_THREADS), or gunicorn's --threads under WSGI, which
+# BLOG_WORKER_THREADS (environment) should then match.
+
+BLOG_WORKER_THREADS = int(os.environ.get('BLOG_WORKER_THREADS', os.environ.get('ASGI_THREADS', 32)))
+
+# Change feed at /api/changes/. ?wait= holds a request up to
+# BLOG_CHANGES_MAX_WAIT seconds for new changes, checking the log every
+# BLOG_CHANGES_POLL_INTERVAL seconds for other processes' writes; past
+# BLOG_CHANGES_MAX_WAITERS held requests, pages are answered at once.
+# A held request holds one of the BLOG_WORKER_THREADS, so the cap must
+# stay well below them or waiting clients starve every other request.
+# Pages stop at sequence gaps younger than BLOG_CHANGES_SETTLE seconds
+# (transactions still committing on databases that allow concurrent writers).
+
+BLOG_CHANGES_MAX_WAIT = 30
+
+BLOG_CHANGES_POLL_INTERVAL = 1
+
+BLOG_CHANGES_MAX_WAITERS = max(1, BLOG_WORKER_THREADS // 4)
+
+BLOG_CHANGES_SETTLE = 5
+
+# Password hashing pool for signup/signin. Hashes beyond the queue, and
+# requests beyond an endpoint's concurrency, get 503 with Retry-After.
+
+BLOG_HASH_WORKERS = None  # None: one per CPU
+
+BLOG_HASH_QUEUE_SIZE = 16
+
+BLOG_HASH_CONCURRENCY = {'signup': 2, 'signin': 4}
+
+BLOG_HASH_RETRY_AFTER = 1
+
+# Per-request instrumentation: Server-Timing headers, and histograms per URL
+# name at /api/_metrics. The endpoint answers staff users, or requests with
+# "Authorization: Bearer <BLOG_METRICS_TOKEN>" when a token is set.
+
+BLOG_METRICS = True
+
+BLOG_SERVER_TIMING = True
+
+BLOG_METRICS_TOKEN = os.environ.get('BLOG_METRICS_TOKEN')
+
+# Admission control for unsafe requests. BLOG_RATE_LIMITS maps URL names to
+# token buckets of (capacity, seconds to refill it), kept per client IP and
+# per signed-in user; an empty bucket answers 429 with Retry-After. Buckets
+# are per process unless BLOG_RATE_LIMIT_CACHE names a shared cache alias.
+# BLOG_TRUSTED_PROXIES lists the addresses or networks of reverse proxies
+# whose X-Forwarded-For names the client; without it, everyone behind a
+# proxy shares one IP bucket. The BLOG_WRITE_VIEWS run at most BLOG_WRITE_CONCURRENCY at a time per
+# process; a request that waits BLOG_WRITE_WAIT seconds for a slot gets 503.
+
+BLOG_RATE_LIMITS = {
+    'signup': (10, 3600),
+    'signin': (20, 60),
+    'article': (120, 60),
+    'article_detail': (120, 60),
+    'article_comment': (120, 60),
+    'comment_detail': (120, 60),
+    'article_bulk': (20, 60),
+    'comment_bulk': (20, 60),
+}
+
+BLOG_RATE_LIMIT_CACHE = None
+
+BLOG_TRUSTED_PROXIES = ()
+
+BLOG_RATE_LIMIT_KEYS = 10000
+
+BLOG_WRITE_VIEWS = ('article', 'article_detail', 'article_comment', 'comment_detail', 'article_bulk', 'comment_bulk')
+
+BLOG_WRITE_CONCURRENCY = 4
+
+BLOG_WRITE_WAIT = 0.1
+
+BLOG_WRITE_RETRY_AFTER = 1
+
+# Server-sent events at /api/article/<id>/comment/stream/. Writes publish
+# through BLOG_EVENTS_BACKEND: LocalBackend reaches this process only, and
+# BrokerBackend fans out to every worker through the blog_event_broker
+# command listening at BLOG_EVENTS_BROKER. Idle streams get a heartbeat
+# every BLOG_EVENTS_HEARTBEAT seconds; past BLOG_EVENTS_MAX_SUBSCRIBERS
+# streams in a process, new ones get 503 with BLOG_EVENTS_RETRY_AFTER.
+# Under myblog.asgi a stream costs a socket; served any other way it holds
+# one of the BLOG_WORKER_THREADS while open, so those streams stop at
+# BLOG_EVENTS_MAX_THREADED_SUBSCRIBERS, a quarter of them as for the
+# change feed's waiters.
+
+BLOG_EVENTS_BACKEND = 'blog.events.LocalBackend'
+
+BLOG_EVENTS_BROKER = ('127.0.0.1', 7390)
+
+BLOG_EVENTS_HEARTBEAT = 15
+
+BLOG_EVENTS_MAX_SUBSCRIBERS = 10000
+
+BLOG_EVENTS_MAX_THREADED_SUBSCRIBERS = max(1, BLOG_WORKER_THREADS // 4)
+
+BLOG_EVENTS_RETRY_AFTER = 5
+
+BLOG_EVENTS_PAGE_SIZE = 500
+
+# Background tasks (blog.tasks), run by `manage.py blog_worker`. Deletes
+# through the API hide rows at once and leave the deleting to a worker,
+# BLOG_PURGE_CHUNK_SIZE rows per transaction. A worker polls every
+# BLOG_TASK_POLL_INTERVAL seconds and holds a task for BLOG_TASK_LEASE
+# seconds; failures are retried after BLOG_TASK_RETRY_DELAY seconds,
+# doubling, until BLOG_TASK_MAX_ATTEMPTS attempts have failed.
+
+BLOG_PURGE_CHUNK_SIZE = 500
+
+BLOG_TASK_POLL_INTERVAL = 1
+
+BLOG_TASK_LEASE = 60
+
+BLOG_TASK_RETRY_DELAY = 5
+
+BLOG_TASK_MAX_ATTEMPTS = 5
+
+# Article and comment bodies of BLOG_COMPRESS_CONTENT_OVER characters or
+# more are stored zlib-compressed (None stores every body as text); run
+# `manage.py blog_compress` after changing it. The SQLite search index keeps
+# the bodies as plain text; tools outside Django (the sqlite3 shell, backup
+# and restore) can write the tables, but cannot read compressed bodies or
+# index any they compress themselves. ?summary=1 list pages carry
+# the first BLOG_SUMMARY_LENGTH characters of each body, taken at write
+# time. Responses of BLOG_COMPRESS_RESPONSES_OVER bytes or more go out with
+# br or gzip to clients that accept it (None sends every body as is).
+
+BLOG_COMPRESS_CONTENT_OVER = None
+
+BLOG_SUMMARY_LENGTH = 200
+
+BLOG_COMPRESS_RESPONSES_OVER = 512